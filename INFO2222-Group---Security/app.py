@@ -4,11 +4,17 @@ this is where you'll find all of the get/post request handlers
 the socket event handlers are inside of socket_routes.py
 '''
 
-from flask import Flask, render_template, request, abort, url_for, jsonify
+from flask import Flask, render_template, request, abort, url_for, jsonify, make_response
 from flask_socketio import SocketIO
-from flask_session import Session
+import auth
+import broker
 import db
+import hashing
+import sessions
+import os
 import secrets
+import hashlib
+import base64
 from werkzeug.security import generate_password_hash, check_password_hash
 
 
@@ -22,20 +28,65 @@ from werkzeug.security import generate_password_hash, check_password_hash
 app = Flask(__name__)
 
 
-# secret key used to sign the session cookie
-app.config['SECRET_KEY'] = secrets.token_hex()
-socketio = SocketIO(app)
-
-#session (use filesystem instead of cookies)
+# secret key used to sign the session cookie and login tokens
+# set SECRET_KEY when running more than one process so they all accept the same tokens
+app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or secrets.token_hex()
+# to run several worker processes, start broker.py and point every worker at it
+# with SOCKETIO_MESSAGE_QUEUE, and share rooms between them with ROOM_REGISTRY=sqlite
+message_queue = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+if message_queue:
+    manager = broker.BrokerManager(message_queue)
+    socketio = SocketIO(app, client_manager=manager)
+    # the workers' db.py caches invalidate each other through the broker
+    manager.on_invalidate = db.apply_invalidation
+    db.share_invalidations(manager.publish_invalidation)
+    # listen right away instead of at the first socket connection,
+    # so invalidations reach workers that have only served plain requests so far
+    socketio.server.manager_initialized = True
+    manager.initialize()
+else:
+    socketio = SocketIO(app)
+
+# "memory" keeps rooms in this process, "sqlite" keeps them in a file every worker shares
+app.config['ROOM_REGISTRY'] = os.environ.get('ROOM_REGISTRY', 'memory')
+app.config['ROOM_REGISTRY_PATH'] = 'database/rooms.db'
+
+# set OUTBOUND_BATCHING=1 to send chat messages in batches, see outbox.py
+# a batch goes out every OUTBOUND_FLUSH_MS milliseconds or once OUTBOUND_BATCH_SIZE messages are waiting
+app.config['OUTBOUND_BATCHING'] = os.environ.get('OUTBOUND_BATCHING') == '1'
+app.config['OUTBOUND_FLUSH_MS'] = float(os.environ.get('OUTBOUND_FLUSH_MS', 5))
+app.config['OUTBOUND_BATCH_SIZE'] = int(os.environ.get('OUTBOUND_BATCH_SIZE', 32))
+
+#session (kept on the server instead of in cookies)
+# "memory" for a single process, "sqlite" when several processes share sessions,
+# "filesystem" for the old flask_session files, see sessions.py
 app.config["SESSION_PERMANENT"] = False
-app.config['SESSION_TYPE'] = 'filesystem'
+app.config['SESSION_TYPE'] = os.environ.get('SESSION_TYPE', 'memory')
+app.config['SESSION_SQLITE_PATH'] = 'database/sessions.db'
+# seconds a session lives after it was last saved, and how often expired ones are removed
+app.config['SESSION_TTL'] = 24 * 60 * 60
+app.config['SESSION_SWEEP_INTERVAL'] = 60
 app.config.update(
     SESSION_COOKIE_SECURE=True,
     SESSION_COOKIE_HTTPONLY=True,
     SESSION_COOKIE_SAMESITE='Lax',
 )
 
-Session(app)
+# "token" signs users in with a stateless signed token instead of a server side session
+# "cookie" keeps the old behaviour of trusting the username the client sends, see auth.py
+app.config['AUTH_MODE'] = os.environ.get('AUTH_MODE', 'cookie')
+app.config['AUTH_TOKEN_TTL'] = 24 * 60 * 60
+
+auth.init_app(app)
+# tokens carry everything a request needs, so token mode skips the session store entirely
+if app.config['AUTH_MODE'] != 'token':
+    sessions.init_app(app)
+
+# largest chat message ciphertext the server accepts, in bytes
+app.config['MAX_CIPHERTEXT_BYTES'] = int(os.environ.get('MAX_CIPHERTEXT_BYTES', 64 * 1024))
+
+# most usernames the key directory answers in one request
+MAX_KEYS_PER_REQUEST = 100
 
 # don't remove this!!
 import socket_routes
@@ -58,9 +109,16 @@ def home():
         abort(404)
     elif request.args.get("username") is None:
         abort(404)
+    if not auth.allowed(request.args.get("username")):
+        abort(403)
         
     return render_template("home.jinja", username=request.args.get("username"), receiver = request.args.get("friend"))
 
+# compares the chat page's message encryption schemes in the browser
+@app.route("/benchmarks/crypto")
+def crypto_benchmark():
+    return render_template("crypto_benchmark.jinja")
+
 # handles when press chat (a friend)
 @app.route("/chat/user", methods=["POST"])
 def chat_user():
@@ -69,8 +127,11 @@ def chat_user():
     username = request.json.get("username")
     friend = request.json.get("friend")
     public_key = request.json.get("public_key")
+    if not auth.allowed(username):
+        abort(403)
 
     db.save_public_key(username, public_key)
+    socket_routes.announce_key(username, db.key_fingerprint(public_key), friend)
     return url_for('home', username=username, friend=friend)
 
 
@@ -90,6 +151,57 @@ def get_public_key():
         return jsonify({'error': 'Public key not found'}), 404
 
 
+# public key directory, GET /keys?username=alice&username=bob
+# answers with every requested key and its fingerprint, clients send back the ETag
+# in If-None-Match and get a 304 until one of the keys changes
+@app.route('/keys', methods=['GET'])
+def get_public_keys():
+    usernames = request.args.getlist('username')
+    if not usernames:
+        return jsonify({'error': 'Username is required'}), 400
+    if len(usernames) > MAX_KEYS_PER_REQUEST:
+        return jsonify({'error': f'At most {MAX_KEYS_PER_REQUEST} usernames per request'}), 400
+
+    entries = db.get_key_entries(usernames)
+    keys = {
+        username: {'fingerprint': fingerprint, 'public_key': public_key}
+        for username, (fingerprint, public_key) in entries.items()
+        if public_key
+    }
+
+    # the ETag only depends on which keys were asked for and their fingerprints
+    version = "|".join(f"{username}={keys[username]['fingerprint'] if username in keys else ''}" for username in sorted(set(usernames)))
+    response = jsonify({'keys': keys})
+    response.set_etag(hashlib.sha256(version.encode()).hexdigest()[:32])
+    # keys rotate whenever a user opens the chat page, so always revalidate
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+
+
+# chat history, GET /history?username=alice&friend=bob&before=120&limit=50
+# pages are fetched by keyset cursor, pass the returned "before" back to get older messages
+@app.route('/history', methods=['GET'])
+def history():
+    username = request.args.get('username')
+    friend = request.args.get('friend')
+    if not username or not friend:
+        return jsonify({'error': 'username and friend are required'}), 400
+    if not auth.allowed(username):
+        abort(403)
+    before = request.args.get('before', type=int)
+    limit = request.args.get('limit', 50, type=int)
+
+    page = db.get_messages(username, friend, before, limit)
+    return jsonify({
+        'messages': [
+            {'seq': seq, 'sender': sender, 'ciphertext': base64.b64encode(ciphertext).decode(), 'created_at': created_at}
+            for seq, sender, ciphertext, created_at in page.messages
+        ],
+        'keys': [{'sender': sender, 'ciphertext': base64.b64encode(ciphertext).decode()} for sender, ciphertext in page.keys],
+        'before': page.next_before,
+    })
+
 
 # handles a get request to the signup page
 @app.route("/signup")
@@ -110,8 +222,11 @@ def signup_user():
 
     if db.get_user(username) is None:
         print("insert")
-        db.insert_user(username, password)
-        return url_for('friends_list', username=username)
+        try:
+            db.insert_user(username, password)
+        except hashing.HashingBusy:
+            return "Error: Server is busy, please try again!"
+        return auth.set_token_cookie(make_response(url_for('friends_list', username=username)), username)
     return "Error: User already exists!"
 
 
@@ -136,10 +251,17 @@ def login_user():
         return "Error: User does not exist!"
     
     
-    if not user.check_password(password):
-        return "Error: Password does not match!"
+    try:
+        if not user.check_password(password):
+            return "Error: Password does not match!"
+    except hashing.HashingBusy:
+        return "Error: Server is busy, please try again!"
+
+    # upgrade hashes made with old settings, without making the user wait for it
+    if user.needs_rehash():
+        db.upgrade_password_hash(username, password, user.password)
 
-    return url_for('friends_list', username=request.json.get("username"))
+    return auth.set_token_cookie(make_response(url_for('friends_list', username=username)), username)
 
 
 
@@ -150,10 +272,13 @@ def friends_list():
     username = request.args.get("username")
     if not username:
         abort(404)
+    if not auth.allowed(username):
+        abort(403)
+    dashboard = db.get_dashboard(username)
     return render_template('friends_list.jinja', username=username, 
-                           friends= db.get_friends(username), 
-                           friend_requests = db.get_friend_requests(username),
-                           sent_friend_requests = db.get_friend_requests_sent(username))
+                           friends = dashboard.friends, 
+                           friend_requests = dashboard.friend_requests,
+                           sent_friend_requests = dashboard.sent_friend_requests)
 
 
 
@@ -165,6 +290,8 @@ def add_friend():
         
     username = request.json.get('username')  
     friend_username = request.json.get('friend_username')   
+    if not auth.allowed(username):
+        abort(403)
     if db.get_user(friend_username) is None or username == friend_username:
         return "Invalid User"
     existing_request = db.check_existing_request(username, friend_username)
@@ -189,6 +316,8 @@ def respond_to_request():
     username = request.json.get("username")
     if not username:
         return url_for('login')
+    if not auth.allowed(username):
+        abort(403)
 
     action = request.json.get('action')
     sender = request.json.get('sender')
@@ -203,6 +332,13 @@ def respond_to_request():
     return url_for('friends_list')
 
 
+# revokes the login token
+@app.route('/logout', methods=['POST'])
+def logout():
+    auth.revoke_token(request.cookies.get(auth.COOKIE_NAME))
+    response = make_response(url_for('index'))
+    response.delete_cookie(auth.COOKIE_NAME)
+    return response
 
 
 
@@ -211,5 +347,5 @@ def respond_to_request():
 if __name__ == '__main__':
     #ssl_context = ('/Users/davis/INFO2222/certs/davisowen.crt', '/Users/davis/INFO2222/certs/davisowen.key') #change to own path to key
     #socketio.run(app, ssl_context=ssl_context, debug=True, host='localhost', port=5000)
-    socketio.run(app)
+    socketio.run(app, port=int(os.environ.get('PORT', 5000)))
 
@@ -0,0 +1,97 @@
+'''
+auth
+stateless signed login tokens, used when AUTH_MODE is "token"
+
+a token is <username>.<expiry>.<nonce>.<signature>, the username is base64url encoded,
+the nonce makes every token unique so one can be revoked without the others,
+and the signature is an HMAC-SHA256 of the first three parts with the app's SECRET_KEY,
+so checking a token is one HMAC and never touches the session store or the database
+revoked tokens are kept in an in-memory deny list until they would have expired anyway
+'''
+
+from threading import Lock
+from typing import Optional
+import base64
+import hashlib
+import hmac
+import secrets
+import time
+
+from flask import request
+
+
+COOKIE_NAME = "auth_token"
+
+# set by init_app
+secret = b""
+enabled = False
+token_ttl = 24 * 60 * 60
+
+# maps the signature of a revoked token to the time the token expires
+deny_list = {}
+deny_list_lock = Lock()
+
+
+def init_app(app):
+    global secret, enabled, token_ttl
+    secret = app.config["SECRET_KEY"].encode()
+    enabled = app.config.get("AUTH_MODE") == "token"
+    token_ttl = app.config.get("AUTH_TOKEN_TTL", token_ttl)
+
+
+def b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def sign(payload: str) -> str:
+    return b64encode(hmac.new(secret, payload.encode(), hashlib.sha256).digest())
+
+
+def issue_token(username: str) -> str:
+    payload = f"{b64encode(username.encode())}.{int(time.time() + token_ttl)}.{secrets.token_urlsafe(6)}"
+    return f"{payload}.{sign(payload)}"
+
+# returns the username the token was issued to, or None if it is forged, expired or revoked
+def verify_token(token: Optional[str]) -> Optional[str]:
+    if not token or token.count(".") != 3:
+        return None
+    payload, signature = token.rsplit(".", 1)
+    # compare_digest only takes ASCII strs, and cookies can hold anything
+    if not hmac.compare_digest(sign(payload).encode(), signature.encode()):
+        return None
+    name, expiry, _ = payload.split(".")
+    if int(expiry) < time.time() or signature in deny_list:
+        return None
+    return b64decode(name).decode()
+
+def revoke_token(token: Optional[str]):
+    if verify_token(token) is None:
+        return
+    _, expiry, _, signature = token.split(".")
+    now = time.time()
+    with deny_list_lock:
+        deny_list[signature] = int(expiry)
+        # expired tokens fail the expiry check anyway, so the list only holds live ones
+        for expired in [key for key, expires in deny_list.items() if expires < now]:
+            del deny_list[expired]
+
+
+# the username of the current request's token
+def current_user() -> Optional[str]:
+    return verify_token(request.cookies.get(COOKIE_NAME))
+
+# in token mode, true only if the request's token belongs to username
+# without tokens every username is trusted like before
+def allowed(username: Optional[str]) -> bool:
+    if not enabled:
+        return True
+    return username is not None and current_user() == username
+
+# adds the login token cookie to a response
+def set_token_cookie(response, username: str):
+    if enabled:
+        response.set_cookie(COOKIE_NAME, issue_token(username), max_age=token_ttl,
+                            httponly=True, secure=True, samesite="Lax")
+    return response
@@ -0,0 +1,84 @@
+'''
+bench_engine
+compares the default SQLAlchemy engine against the tuned engine profile in db.py
+on concurrent insert_user / get_user / get_friends workloads
+
+run it from the project folder:
+    python benchmarks/bench_engine.py --users 2000 --threads 16
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# importing db opens DB_URL and migrates it, so point it at a scratch database first
+os.environ.setdefault("DB_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+
+import db
+from models import Base, User
+
+
+# PBKDF2 would dominate every insert, we only want to measure the database here
+def cheap_set_password(self, password):
+    self.password = password
+
+
+def run_workload(profile: str, users: int, threads: int):
+    folder = tempfile.mkdtemp()
+    db.engine = db.make_engine(f"sqlite:///{os.path.join(folder, 'bench.db')}", profile)
+    Base.metadata.create_all(db.engine)
+
+    names = [f"user{i}" for i in range(users)]
+
+    def insert(name):
+        db.insert_user(name, "password")
+
+    def read(name):
+        db.get_user(name)
+        db.get_friends(name)
+
+    # half of the users exist before the mixed phase starts
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(insert, names[: users // 2]))
+    insert_time = time.perf_counter() - start
+
+    # mixed phase: the remaining signups race against lookups of existing users
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        futures = [pool.submit(insert, name) for name in names[users // 2:]]
+        for _ in range(4):
+            futures += [pool.submit(read, name) for name in names[: users // 2]]
+        for future in futures:
+            future.result()
+    mixed_time = time.perf_counter() - start
+
+    db.engine.dispose()
+    return insert_time, mixed_time, len(futures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=16)
+    args = parser.parse_args()
+
+    User.set_password = cheap_set_password
+    # every read has to reach the engine, otherwise we'd be benchmarking the cache
+    for cache in db.caches:
+        cache.maxsize = 0
+
+    print(f"{'profile':<10}{'inserts/s':>12}{'mixed ops/s':>14}")
+    for profile in ("default", "tuned"):
+        insert_time, mixed_time, ops = run_workload(profile, args.users, args.threads)
+        print(f"{profile:<10}{(args.users // 2) / insert_time:>12.0f}{ops / mixed_time:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
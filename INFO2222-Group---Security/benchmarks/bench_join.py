@@ -0,0 +1,122 @@
+'''
+bench_join
+measures socket "join" latency when every client re-joins at once, like after a reconnect storm
+    serialized  one join at a time, like a single worker that blocks on every query
+    single      one get_user per user
+    batched     one get_users IN query for both users, what join does now
+
+Flask-SocketIO runs in threading mode here (there is no eventlet or gevent), which handles
+every event on its own thread, so a join waiting on the database doesn't hold up the others.
+serialized against batched shows what that is worth, --query-ms adds that much latency to
+every lookup, like a slower disk, so the difference doesn't depend on this machine's SQLite
+
+run it from the project folder:
+    python benchmarks/bench_join.py --clients 500
+'''
+
+import argparse
+import contextlib
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# the app imports db, so point it at a scratch database first
+os.environ.setdefault("DB_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+
+import db
+from app import app, socketio
+from db import get_user
+from models import User
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+# get_users the way join used to look users up, one query per user
+def get_users_one_by_one(usernames):
+    return {username: get_user(username) for username in usernames}
+
+
+def run_joins(clients: int, serialized: bool):
+    sockets = []
+    for i in range(clients):
+        http = app.test_client()
+        http.set_cookie("localhost", "username", f"user{i}")
+        sockets.append(socketio.test_client(app, flask_test_client=http))
+    latencies = []
+    errors = []
+    barrier = threading.Barrier(clients)
+    # held for the whole join when serialized, so joins run one after another
+    worker = threading.Lock() if serialized else contextlib.nullcontext()
+
+    def join(i):
+        barrier.wait()
+        start = time.perf_counter()
+        try:
+            with worker:
+                sockets[i].emit("join", f"user{i}", f"user{(i + 1) % clients}", callback=True)
+            latencies.append(time.perf_counter() - start)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=join, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for client in sockets:
+        client.disconnect()
+    return latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--query-ms", type=float, default=5, help="latency added to every user lookup")
+    args = parser.parse_args()
+    print(f"async mode: {socketio.async_mode}")
+
+    User.set_password = lambda self, password: setattr(self, "password", password)
+    for i in range(args.clients):
+        if db.get_user(f"user{i}") is None:
+            db.insert_user(f"user{i}", "password")
+
+    batched_get_users = db.get_users
+
+    # each lookup pays the added latency once per query
+    def slow(get_users, queries):
+        def lookup(usernames):
+            time.sleep(args.query_ms / 1000 * queries(usernames))
+            return get_users(usernames)
+        return lookup
+
+    modes = (
+        ("serialized", slow(batched_get_users, lambda usernames: 1), True),
+        ("single", slow(get_users_one_by_one, len), False),
+        ("batched", slow(batched_get_users, lambda usernames: 1), False),
+    )
+    print(f"{'mode':<10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'errors':>8}")
+    for mode, get_users, serialized in modes:
+        # every lookup should reach the database, like a cold reconnect storm
+        db.clear_caches()
+        for cache in db.caches:
+            cache.maxsize = 0
+        db.get_users = get_users
+        latencies, errors = run_joins(args.clients, serialized)
+        if not latencies:
+            print(f"{mode:<10}{'-':>10}{'-':>10}{'-':>10}{len(errors):>8}")
+            continue
+        print(f"{mode:<10}{percentile(latencies, 0.5) * 1000:>10.1f}{percentile(latencies, 0.99) * 1000:>10.1f}"
+              f"{max(latencies) * 1000:>10.1f}{len(errors):>8}")
+    db.get_users = batched_get_users
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+'''
+bench_logins
+how long socket events take while a burst of logins is being checked
+    idle      no logins, the baseline
+    inline    every login verifies its password on the request thread, like before hashing.py
+    pool      logins verify in the hashing process pool, what login does now
+
+one client sends a "history" event every 10ms while --logins users log in at once,
+the event latencies are taken while the logins are in flight
+run it from the project folder:
+    python benchmarks/bench_logins.py --logins 100
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# the app imports db, so point it at a scratch database first
+os.environ.setdefault("DB_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench.db')}")
+
+import db
+import hashing
+from app import app, socketio
+from models import User
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_logins(logins: int):
+    http = app.test_client()
+    http.set_cookie("localhost", "username", "chat_a")
+    chat = socketio.test_client(app, flask_test_client=http)
+
+    latencies = []
+    done = threading.Event()
+
+    # sends an event every 10ms until the logins are done
+    # latency counts from when the event was due, so time spent waiting for the GIL
+    # before it could even be sent shows up too
+    def chatter():
+        while not done.is_set():
+            due = time.perf_counter() + 0.01
+            time.sleep(0.01)
+            chat.emit("history", "chat_a", "chat_b", None, 1, callback=True)
+            latencies.append(time.perf_counter() - due)
+
+    barrier = threading.Barrier(logins + 1) if logins else None
+    failures = []
+
+    def login(i):
+        barrier.wait()
+        response = app.test_client().post("/login/user", json={"username": f"login{i}", "password": "password"})
+        if response.get_data(as_text=True).startswith("Error"):
+            failures.append(response.get_data(as_text=True))
+
+    threads = [threading.Thread(target=login, args=(i,)) for i in range(logins)]
+    for thread in threads:
+        thread.start()
+    chat_thread = threading.Thread(target=chatter)
+    chat_thread.start()
+    start = time.perf_counter()
+    if logins:
+        barrier.wait()
+        for thread in threads:
+            thread.join()
+    else:
+        time.sleep(1)
+    elapsed = time.perf_counter() - start
+    done.set()
+    chat_thread.join()
+    chat.disconnect()
+    return latencies, elapsed, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--logins", type=int, default=100)
+    args = parser.parse_args()
+
+    # every user gets the same hash, made once, so setting up doesn't take minutes
+    password_hash = hashing.hasher.hash("password")
+    set_password = User.set_password
+    User.set_password = lambda self, password: setattr(self, "password", password_hash)
+    for username in ["chat_a", "chat_b"] + [f"login{i}" for i in range(args.logins)]:
+        if db.get_user(username) is None:
+            db.insert_user(username, "password")
+    User.set_password = set_password
+
+    check_password = User.check_password
+    modes = (
+        ("idle", 0, check_password),
+        ("inline", args.logins, lambda self, password: hashing.verify(self.password, password)),
+        ("pool", args.logins, check_password),
+    )
+    print(f"{hashing.hasher.prefix()}, {hashing.HASH_WORKERS} hashing workers")
+    print(f"{'mode':<8}{'logins s':>10}{'events':>8}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'failed':>8}")
+    for mode, logins, check in modes:
+        User.check_password = check
+        latencies, elapsed, failures = run_logins(logins)
+        print(f"{mode:<8}{elapsed:>10.2f}{len(latencies):>8}{percentile(latencies, 0.5) * 1000:>10.1f}"
+              f"{percentile(latencies, 0.99) * 1000:>10.1f}{max(latencies) * 1000:>10.1f}{len(failures):>8}")
+    User.check_password = check_password
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+'''
+bench_outbox
+frames and CPU time per chat message with outbound batching on and off
+
+a burst of messages is sent to rooms of a few members each, through a Socket.IO server
+whose transport only encodes and counts the frames, so the numbers are the server's own
+cost of fanning messages out, without any network in the way
+run it from the project folder:
+    python benchmarks/bench_outbox.py --rooms 100 --members 2 --messages 20000
+'''
+
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import socketio
+
+from outbox import Outbox
+
+
+# stands in for Engine.IO, encoding each packet like the real transport would
+class CountingTransport():
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+
+    def send_packet(self, eio_sid, packet):
+        self.frames += 1
+        self.bytes += len(packet.encode())
+
+
+def make_server(rooms: int, members: int):
+    server = socketio.Server(async_mode="threading")
+    transport = CountingTransport()
+    server.eio.send_packet = transport.send_packet
+    for room_id in range(rooms):
+        for member in range(members):
+            sid = server.manager.connect(f"eio-{room_id}-{member}", "/")
+            server.manager.enter_room(sid, "/", f"room{room_id}")
+    return server, transport
+
+
+def run(args, batching: bool):
+    server, transport = make_server(args.rooms, args.members)
+    outbox = Outbox(server, args.flush_ms / 1000, args.batch_size) if batching else None
+    rng = random.Random(2222)
+    targets = [f"room{rng.randrange(args.rooms)}" for _ in range(args.messages)]
+    message = "user: " + "x" * args.size
+
+    cpu = time.process_time()
+    start = time.perf_counter()
+    for room_id in targets:
+        if outbox is not None:
+            outbox.post(room_id, message)
+        else:
+            server.emit("incoming", message, to=room_id)
+    if outbox is not None:
+        outbox.flush()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    return transport, elapsed, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument("--members", type=int, default=2)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--size", type=int, default=200, help="characters per message")
+    parser.add_argument("--flush-ms", type=float, default=5)
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    print(f"{'batching':<10}{'frames':>10}{'frames/s':>12}{'MiB':>8}{'cpu us/msg':>12}")
+    for batching in (False, True):
+        transport, elapsed, cpu = run(args, batching)
+        print(f"{'on' if batching else 'off':<10}{transport.frames:>10}{transport.frames / elapsed:>12.0f}"
+              f"{transport.bytes / 2 ** 20:>8.1f}{cpu / args.messages * 1e6:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
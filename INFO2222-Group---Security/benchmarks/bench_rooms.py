@@ -0,0 +1,84 @@
+'''
+bench_rooms
+micro-benchmarks for models.Room with a large number of memberships
+
+every user chats with several friends at once, so users belong to many rooms
+run it from the project folder:
+    python benchmarks/bench_rooms.py --memberships 1000000
+'''
+
+import argparse
+import random
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from models import Room
+
+
+def timed(label: str, operations: int, function):
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<20}{operations:>10}{elapsed:>10.2f}s{elapsed / operations * 1e9:>10.0f} ns/op")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--memberships", type=int, default=1000000)
+    parser.add_argument("--rooms-per-user", type=int, default=10)
+    parser.add_argument("--memory", action="store_true", help="also measure memory, much slower")
+    args = parser.parse_args()
+
+    rng = random.Random(2222)
+    # every room has two members, so this many rooms gives the requested memberships
+    rooms = args.memberships // 2
+    users = max(2, args.memberships // args.rooms_per_user)
+    # one room per conversation, so every pair is distinct
+    pairs = set()
+    while len(pairs) < rooms:
+        a, b = rng.randrange(users), rng.randrange(users)
+        if a < b:
+            pairs.add((f"user{a}", f"user{b}"))
+    pairs = list(pairs)
+
+    if args.memory:
+        tracemalloc.start()
+    registry = Room()
+    room_ids = []
+
+    print(f"{'operation':<20}{'count':>10}{'total':>11}{'per op':>13}")
+
+    def create():
+        for sender, receiver in pairs:
+            room_ids.append(registry.create_room(sender, receiver))
+    timed("create_room", rooms, create)
+
+    def join():
+        for room_id, (_, receiver) in zip(room_ids, pairs):
+            registry.join_room(receiver, room_id)
+    timed("join_room", rooms, join)
+
+    if args.memory:
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"memory for {rooms * 2} memberships: {current / 2 ** 20:.0f} MiB, {current / (rooms * 2):.0f} bytes each")
+
+    timed("get_room_id", rooms, lambda: [registry.get_room_id(receiver, sender) for sender, receiver in pairs])
+    timed("get_user_rooms", rooms, lambda: [registry.get_user_rooms(name) for name, _ in pairs])
+    timed("get_room_users", rooms, lambda: [registry.get_room_users(room_id) for room_id in room_ids])
+    timed("can_chat", rooms, lambda: [registry.can_chat(room_id) for room_id in room_ids])
+
+    def leave():
+        for room_id, (sender, receiver) in zip(room_ids, pairs):
+            registry.leave_room(sender, room_id)
+            registry.leave_room(receiver, room_id)
+    timed("leave_room", rooms * 2, leave)
+    print(f"rooms left: {len(registry.rooms)}, users left: {len(registry.user_rooms)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+'''
+bench_sessions
+request latency of each session backend with a large number of live sessions
+
+run it from the project folder:
+    python benchmarks/bench_sessions.py --sessions 100000 --requests 2000
+'''
+
+import argparse
+import os
+import random
+import secrets
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from flask import Flask, session
+
+import sessions
+
+
+def make_app(session_type: str, folder: str) -> Flask:
+    app = Flask(__name__)
+    app.config.update(
+        SECRET_KEY="bench",
+        SESSION_TYPE=session_type,
+        SESSION_PERMANENT=False,
+        SESSION_SQLITE_PATH=os.path.join(folder, "sessions.db"),
+        SESSION_FILE_DIR=os.path.join(folder, "flask_session"),
+        SESSION_FILE_THRESHOLD=10 ** 9,
+        SESSION_SWEEP_INTERVAL=3600,
+    )
+    sessions.init_app(app)
+
+    @app.route("/")
+    def visit():
+        session["visits"] = session.get("visits", 0) + 1
+        return str(session["visits"])
+
+    return app
+
+
+def fill(app: Flask, count: int):
+    interface = app.session_interface
+    sids = [secrets.token_urlsafe(32) for _ in range(count)]
+    if hasattr(interface, "store"):
+        store = interface.store
+        if isinstance(store, sessions.SqliteSessionStore):
+            conn = store.connect()
+            conn.execute("BEGIN")
+            for sid in sids:
+                store.set(sid, {"visits": 1, "username": sid[:8]}, 3600)
+            conn.execute("COMMIT")
+        else:
+            for sid in sids:
+                store.set(sid, {"visits": 1, "username": sid[:8]}, 3600)
+    else:
+        # flask_session's filesystem backend, one file per session
+        for sid in sids:
+            interface.cache.set(interface.key_prefix + sid, {"visits": 1, "username": sid[:8]}, 3600)
+    return sids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=100000)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--backends", nargs="+", default=["memory", "sqlite", "filesystem"])
+    args = parser.parse_args()
+
+    print(f"{'backend':<12}{'fill s':>8}{'p50 us':>10}{'p99 us':>10}{'sweep ms':>10}")
+    for backend in args.backends:
+        folder = tempfile.mkdtemp()
+        try:
+            app = make_app(backend, folder)
+        except ImportError:
+            print(f"{backend:<12}{'not installed':>38}")
+            continue
+        start = time.perf_counter()
+        sids = fill(app, args.sessions)
+        fill_time = time.perf_counter() - start
+
+        client = app.test_client()
+        cookie = app.config["SESSION_COOKIE_NAME"]
+        latencies = []
+        for sid in random.sample(sids, min(args.requests, len(sids))):
+            client.set_cookie("localhost", cookie, sid)
+            start = time.perf_counter()
+            client.get("/")
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+
+        sweep = "-"
+        if hasattr(app.session_interface, "store"):
+            start = time.perf_counter()
+            app.session_interface.store.sweep()
+            sweep = f"{(time.perf_counter() - start) * 1000:.1f}"
+
+        print(f"{backend:<12}{fill_time:>8.1f}{latencies[len(latencies) // 2] * 1e6:>10.0f}"
+              f"{latencies[int(len(latencies) * 0.99)] * 1e6:>10.0f}{sweep:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+'''
+bench_wire
+payload size and server CPU per chat message for the two ways ciphertext has travelled
+    json      the page sends a JSON list of byte values and the server echoes it back as text
+    binary    the page sends an ArrayBuffer, a binary attachment, and the server forwards the bytes
+
+each message goes through what the server does with it: decode the incoming "send" packet,
+then build and encode the packet for the recipients
+run it from the project folder:
+    python benchmarks/bench_wire.py --messages 20000 --size 256
+'''
+
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from socketio import packet
+
+
+# what the page sent before, and what send made of it
+def client_json(ciphertext: bytes):
+    return packet.Packet(packet.EVENT, ["send", "alice", list(ciphertext), 1234]).encode()
+
+def server_json(encoded):
+    username, message, _ = packet.Packet(encoded_packet=encoded).data[1:]
+    return packet.Packet(packet.EVENT, ["incoming", f"{username}: {message}"]).encode()
+
+
+# an ArrayBuffer comes in as a placeholder and an attachment, and goes out the same way
+def client_binary(ciphertext: bytes):
+    return packet.Packet(packet.EVENT, ["send", "alice", ciphertext, 1234]).encode()
+
+def server_binary(encoded):
+    incoming = packet.Packet(encoded_packet=encoded[0])
+    for attachment in encoded[1:]:
+        incoming.add_attachment(attachment)
+    username, message, _ = incoming.data[1:]
+    return packet.Packet(packet.EVENT, ["incoming_ciphertext", {"sender": username, "ciphertext": message}]).encode()
+
+
+# every part of an encoded packet is one websocket frame
+def wire_size(encoded) -> int:
+    if not isinstance(encoded, list):
+        encoded = [encoded]
+    return sum(len(part.encode() if isinstance(part, str) else part) for part in encoded)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--size", type=int, default=256, help="ciphertext bytes, 256 for RSA-2048")
+    args = parser.parse_args()
+
+    ciphertexts = [os.urandom(args.size) for _ in range(1000)]
+
+    print(f"{'format':<10}{'sent B':>10}{'received B':>12}{'server us/msg':>15}")
+    for name, client, server in (("json", client_json, server_json), ("binary", client_binary, server_binary)):
+        sent = [client(ciphertexts[i % len(ciphertexts)]) for i in range(args.messages)]
+        start = time.process_time()
+        received = [server(encoded) for encoded in sent]
+        cpu = time.process_time() - start
+        print(f"{name:<10}{wire_size(sent[0]):>10}{wire_size(received[0]):>12}{cpu / args.messages * 1e6:>15.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+'''
+broker
+a tiny local message broker so several app processes can share Socket.IO events
+
+python-socketio fans events out between servers through a pub/sub backend such as redis.
+This is a stand-in that needs nothing but the standard library: every process connects to
+the broker over TCP and each line a process sends is forwarded to every connected process.
+It is meant for running a few workers on one machine, not for anything bigger.
+
+start the broker, then start each worker with the same SOCKETIO_MESSAGE_QUEUE:
+    python broker.py --port 5555
+    SOCKETIO_MESSAGE_QUEUE=tcp://127.0.0.1:5555 PORT=5000 python app.py
+    SOCKETIO_MESSAGE_QUEUE=tcp://127.0.0.1:5555 PORT=5001 python app.py
+'''
+
+from threading import Lock
+from urllib.parse import urlparse
+import argparse
+import json
+import socket
+import socketserver
+import sys
+import time
+
+import socketio
+
+
+# forwards every line it receives to all connected clients
+class BrokerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, BrokerHandler)
+        self.clients = set()
+        self.lock = Lock()
+
+    def publish(self, line: bytes):
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            try:
+                client.sendall(line)
+            except OSError:
+                with self.lock:
+                    self.clients.discard(client)
+
+class BrokerHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        with self.server.lock:
+            self.server.clients.add(self.connection)
+        try:
+            for line in self.rfile:
+                self.server.publish(line)
+        except OSError:
+            pass
+        finally:
+            with self.server.lock:
+                self.server.clients.discard(self.connection)
+
+
+# Socket.IO client manager that publishes and listens through the broker
+# messages are JSON, one per line
+# besides Socket.IO's own messages it carries cache invalidations between workers
+# needs the python-socketio in requirements.txt, 5.8's PubSubManager takes no json argument
+# and doesn't base64 binary attachments, so bytes ciphertexts couldn't be published as JSON
+class BrokerManager(socketio.PubSubManager):
+    name = "broker"
+    # called with (cache name, keys) for every invalidation another process publishes
+    on_invalidate = None
+
+    def __init__(self, url="tcp://127.0.0.1:5555", channel="socketio", write_only=False, logger=None, json=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        address = urlparse(url)
+        self.address = (address.hostname, address.port)
+        self.connection = None
+        self.lock = Lock()
+
+    def open_connection(self) -> socket.socket:
+        connection = socket.create_connection(self.address)
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection
+
+    def _publish(self, data):
+        line = (json.dumps({"channel": self.channel, "data": data}) + "\n").encode()
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.connection is None:
+                        self.connection = self.open_connection()
+                    self.connection.sendall(line)
+                    return
+                except OSError:
+                    self.connection = None
+                    if attempt:
+                        raise
+
+    # tells the other processes to drop these keys from their copy of a db.py cache
+    def publish_invalidation(self, cache: str, keys):
+        try:
+            self._publish({"method": "invalidate", "host_id": self.host_id, "cache": cache, "keys": list(keys)})
+        except OSError:
+            self._get_logger().error("Could not publish a cache invalidation, the message broker is down")
+
+    def _listen(self):
+        while True:
+            try:
+                with self.open_connection() as connection:
+                    for line in connection.makefile("rb"):
+                        message = json.loads(line)
+                        if message.get("channel") != self.channel:
+                            continue
+                        data = message["data"]
+                        if isinstance(data, dict) and data.get("method") == "invalidate":
+                            if data.get("host_id") != self.host_id and self.on_invalidate is not None:
+                                self.on_invalidate(data["cache"], data["keys"])
+                            continue
+                        yield data
+            except OSError:
+                self._get_logger().error("Lost the connection to the message broker, retrying")
+            time.sleep(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5555)
+    args = parser.parse_args()
+
+    with BrokerServer((args.host, args.port)) as server:
+        print(f"broker listening on tcp://{args.host}:{args.port}")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
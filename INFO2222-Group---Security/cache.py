@@ -0,0 +1,91 @@
+'''
+cache
+small in-process read-through cache used in front of the db.py lookups
+entries are evicted least recently used first once the cache is full,
+and expire ttl seconds after they were loaded
+'''
+
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+import time
+
+
+# marks a key that isn't in the cache, since None is a valid cached value
+MISSING = object()
+
+class LRUCache():
+    def __init__(self, name: str, maxsize: int = 10000, ttl: float = 60.0):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # maps the key to (expiry time, value), oldest used first
+        self.entries: OrderedDict = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        # bumped by every invalidation, so a value loaded before a write
+        # that happened during the load is never stored
+        self.generation = 0
+        # called with (name, keys) after every invalidate, see db.share_invalidations
+        self.listeners = []
+
+    def get(self, key, default=MISSING):
+        with self.lock:
+            entry = self.entries.get(key, MISSING)
+            if entry is not MISSING:
+                expires, value = entry
+                if expires > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, generation=None):
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        self.invalidate_local(*keys)
+        for listener in self.listeners:
+            listener(self.name, keys)
+
+    # drops the keys without telling the listeners, for invalidations made by another process
+    def invalidate_local(self, *keys):
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    # decorator for a lookup function that takes a single key argument
+    def cached(self, function):
+        @wraps(function)
+        def wrapper(key):
+            generation = self.generation
+            value = self.get(key)
+            if value is MISSING:
+                value = function(key)
+                self.set(key, value, generation)
+            return value
+        return wrapper
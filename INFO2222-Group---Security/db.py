@@ -3,24 +3,132 @@ db
 database file, containing all the logic to interface with the sql database
 '''
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, select, text, literal, delete, update
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.orm import Session
 from models import *
+from cache import LRUCache, MISSING
+import hashing
+import migrations
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from threading import Event, Lock, Thread
+from typing import Dict, List, NamedTuple, Optional, Tuple
+import atexit
+import hashlib
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
 
 # creates the database directory
 Path("database") \
     .mkdir(exist_ok=True)
 
+# engine profiles, pick one with the DB_PROFILE environment variable
+# "default" is plain SQLAlchemy (rollback journal, default pool)
+# "tuned" turns on WAL so readers don't stall behind writers, and sizes the pool
+ENGINE_PROFILES = {
+    "default": {
+        "pragmas": {},
+        "pool": {},
+    },
+    "tuned": {
+        "pragmas": {
+            "journal_mode": "WAL",
+            # NORMAL is safe under WAL, only the last commits can be lost on power failure
+            "synchronous": "NORMAL",
+            # negative means KiB, so this is a 64MB page cache per connection
+            "cache_size": -64000,
+            "mmap_size": 268435456,
+            # milliseconds a writer waits for the lock before raising "database is locked"
+            "busy_timeout": 5000,
+            "temp_store": "MEMORY",
+        },
+        "pool": {
+            "pool_size": 10,
+            "max_overflow": 20,
+            "pool_timeout": 30,
+            "pool_pre_ping": False,
+        },
+    },
+}
+
+# creates an engine with the given profile
+# every pooled connection gets the profile's pragmas when it is opened
+def make_engine(url: str, profile: str = "tuned", echo: bool = False):
+    if profile not in ENGINE_PROFILES:
+        raise ValueError(f"Unknown engine profile: {profile}")
+    settings = ENGINE_PROFILES[profile]
+    new_engine = create_engine(url, echo=echo, **settings["pool"])
+
+    pragmas = settings["pragmas"]
+    if pragmas:
+        @event.listens_for(new_engine, "connect")
+        def set_pragmas(dbapi_connection, _):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+            cursor.close()
+
+    return new_engine
+
 # "database/main.db" specifies the database file
-# change it if you wish
+# change it with the DB_URL environment variable if you wish
 # turn echo = True to display the sql output
-engine = create_engine("sqlite:///database/main.db", echo=False)
+DB_URL = os.environ.get("DB_URL", "sqlite:///database/main.db")
+DB_PROFILE = os.environ.get("DB_PROFILE", "tuned")
+engine = make_engine(DB_URL, DB_PROFILE, echo=False)
 
 # initializes the database
 Base.metadata.create_all(engine)
 
+# brings databases created by older versions up to date
+migrations.migrate(engine)
+
+# threads for background database writes that no request waits on, like password hash upgrades
+# keep it at or below the engine's pool size so queued writes wait here, not on the pool
+DB_EXECUTOR_THREADS = int(os.environ.get("DB_EXECUTOR_THREADS", 8))
+executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_THREADS, thread_name_prefix="db")
+
+# read-through caches in front of the hot lookups
+# every write below invalidates exactly the keys it changes
+CACHE_SIZE = int(os.environ.get("DB_CACHE_SIZE", 10000))
+CACHE_TTL = float(os.environ.get("DB_CACHE_TTL", 60))
+user_cache = LRUCache("user", CACHE_SIZE, CACHE_TTL)
+friends_cache = LRUCache("friends", CACHE_SIZE, CACHE_TTL)
+friend_requests_cache = LRUCache("friend_requests", CACHE_SIZE, CACHE_TTL)
+dashboard_cache = LRUCache("dashboard", CACHE_SIZE, CACHE_TTL)
+caches = [user_cache, friends_cache, friend_requests_cache, dashboard_cache]
+
+# hit/miss counters and sizes of every cache, use these to size CACHE_SIZE
+def cache_stats() -> dict:
+    return {cache.name: cache.stats() for cache in caches}
+
+def clear_caches():
+    for cache in caches:
+        cache.clear()
+
+# every worker process has its own caches, so a write on one has to reach the others
+# publish is called with (cache name, keys) for every invalidation made in this process,
+# and apply_invalidation drops the same keys when another process publishes them
+def share_invalidations(publish):
+    for cache in caches:
+        cache.listeners.append(publish)
+
+def apply_invalidation(name: str, keys):
+    for cache in caches:
+        if cache.name == name:
+            cache.invalidate_local(*keys)
+
+# drops everything cached about a friendship or request between the two users
+def invalidate_pair(sender_username: str, receiver_username: str):
+    friends_cache.invalidate(sender_username, receiver_username)
+    friend_requests_cache.invalidate(sender_username, receiver_username)
+    dashboard_cache.invalidate(sender_username, receiver_username)
+
 # inserts a user to the database
 def insert_user(username: str, password: str):
     with Session(engine) as session:
@@ -30,37 +138,107 @@ def insert_user(username: str, password: str):
 
         session.add(user)
         session.commit()
+    # get_user caches unknown usernames as None
+    user_cache.invalidate(username)
+
+# re-hashes a password with the current hasher after a successful login, without waiting for it
+# the hash runs in the hashing pool and only the UPDATE takes a database thread
+# when the hashing pool is busy the upgrade is skipped, the next login tries again
+def upgrade_password_hash(username: str, password: str, old_hash: str):
+    future = hashing.submit(hashing.hasher.hash, password)
+    if future is None:
+        return
+
+    def hashed(future):
+        if future.exception() is not None:
+            logger.warning("Upgrading the password hash of %s failed: %s", username, future.exception())
+            return
+        executor.submit(replace_password_hash, username, old_hash, future.result())
+    future.add_done_callback(hashed)
+
+# only replaces the hash if it is still the one the password was checked against
+def replace_password_hash(username: str, old_hash: str, new_hash: str):
+    with Session(engine) as session:
+        session.execute(
+            update(User).where(User.username == username, User.password == old_hash).values(password=new_hash)
+        )
+        session.commit()
+    user_cache.invalidate(username)
 
 # gets a user from the database
+@user_cache.cached
 def get_user(username: str):
     with Session(engine) as session:
         return session.get(User, username)
+
+# gets any number of users with one IN query, maps each username to its User or None
+# users already in the cache don't hit the database at all
+def get_users(usernames) -> Dict[str, Optional[User]]:
+    users = {}
+    missing = []
+    for username in usernames:
+        user = user_cache.get(username)
+        if user is MISSING:
+            missing.append(username)
+        else:
+            users[username] = user
+
+    if missing:
+        generation = user_cache.generation
+        with Session(engine) as session:
+            found = {user.username: user for user in session.scalars(select(User).where(User.username.in_(missing)))}
+        for username in missing:
+            users[username] = found.get(username)
+            user_cache.set(username, users[username], generation)
+    return users
     
 #Friend successfully added to database
 def add_friend(username: str, friend_username: str):
+    user_id, friend_id = Friendship.pair(username, friend_username)
     with Session(engine) as session:
-        session.add(Friendship(user_id=username, friend_id=friend_username))
-        session.add(Friendship(user_id=friend_username, friend_id=username))
+        session.add(Friendship(user_id=user_id, friend_id=friend_id))
         session.commit()
+    invalidate_pair(username, friend_username)
    
 #request added to database
 def send_friend_request(sender_username: str, receiver_username: str):
     with Session(engine) as session:
         session.add(FriendRequest(sender_id=sender_username, receiver_id=receiver_username, status='pending'))
         session.commit()
+    invalidate_pair(sender_username, receiver_username)
         
 
 
 
 #accepted request to database
 def accept_friend_request(sender_username: str, receiver_username: str):
+    return len(accept_friend_requests(receiver_username, [sender_username])) == 1
+
+# accepts any number of pending requests sent to receiver_username in one transaction
+# the pending requests are deleted and the friendships inserted in one bulk insert
+# returns the senders whose requests were accepted
+def accept_friend_requests(receiver_username: str, sender_usernames) -> List[str]:
+    sender_usernames = list(sender_usernames)
+    if not sender_usernames:
+        return []
     with Session(engine) as session:
-        friend_request = session.query(FriendRequest).filter_by(sender_id=sender_username, receiver_id = receiver_username, status = "pending").first()
-        if friend_request:
-            friend_request.status = 'accepted'
-            add_friend(friend_request.sender_id, friend_request.receiver_id) 
-            session.delete(friend_request)
-            session.commit()
+        accepted = list(session.execute(
+            delete(FriendRequest)
+                .where(FriendRequest.receiver_id == receiver_username,
+                       FriendRequest.sender_id.in_(sender_usernames),
+                       FriendRequest.status == "pending")
+                .returning(FriendRequest.sender_id)
+        ).scalars())
+        if accepted:
+            rows = []
+            for sender in accepted:
+                user_id, friend_id = Friendship.pair(sender, receiver_username)
+                rows.append({"user_id": user_id, "friend_id": friend_id})
+            session.execute(insert(Friendship).on_conflict_do_nothing(), rows)
+        session.commit()
+    for sender in accepted:
+        invalidate_pair(sender, receiver_username)
+    return accepted
             
             
             
@@ -72,20 +250,19 @@ def reject_friend_request(sender_username: str, receiver_username: str):
             friend_request.status = 'reject'
             session.delete(friend_request)
             session.commit()
+            invalidate_pair(sender_username, receiver_username)
 
 #get friends from database
+# each half of the union is an index-only scan, no ORM objects are loaded
+@friends_cache.cached
 def get_friends(username: str):
+    query = select(Friendship.friend_id).where(Friendship.user_id == username) \
+        .union_all(select(Friendship.user_id).where(Friendship.friend_id == username))
     with Session(engine) as session:
-        friendships = session.query(Friendship).filter((Friendship.user_id == username) | (Friendship.friend_id == username)).all()
-        friends = set()
-        for friendship in friendships:
-            if friendship.user_id != username:
-                friends.add(friendship.user_id)
-            else:
-                friends.add(friendship.friend_id)
-        return list(friends)
+        return list(session.execute(query).scalars())
 
 #get friend requests from database
+@friend_requests_cache.cached
 def get_friend_requests(receiver_username: str):
     with Session(engine) as session:
         return session.query(FriendRequest).filter_by(receiver_id=receiver_username, status='pending').all()
@@ -97,6 +274,39 @@ def get_friend_requests_sent(sender_username: str):
         return session.query(FriendRequest).filter_by(sender_id=sender_username).all()
 
 
+# everything the friends list page shows, as plain tuples
+# friend_requests holds (sender, status) rows and sent_friend_requests holds (receiver, status) rows
+class Dashboard(NamedTuple):
+    friends: List[str]
+    friend_requests: list
+    sent_friend_requests: list
+
+# friends, received pending requests and sent requests in one statement and one session
+@dashboard_cache.cached
+def get_dashboard(username: str) -> Dashboard:
+    query = select(literal("friend").label("kind"), Friendship.friend_id.label("name"), literal(None).label("status")) \
+        .where(Friendship.user_id == username) \
+        .union_all(
+            select(literal("friend"), Friendship.user_id, literal(None))
+                .where(Friendship.friend_id == username),
+            select(literal("received"), FriendRequest.sender_id, FriendRequest.status)
+                .where(FriendRequest.receiver_id == username, FriendRequest.status == "pending"),
+            select(literal("sent"), FriendRequest.receiver_id, FriendRequest.status)
+                .where(FriendRequest.sender_id == username),
+        )
+
+    dashboard = Dashboard([], [], [])
+    with Session(engine) as session:
+        for kind, name, status in session.execute(query):
+            if kind == "friend":
+                dashboard.friends.append(name)
+            elif kind == "received":
+                dashboard.friend_requests.append((name, status))
+            else:
+                dashboard.sent_friend_requests.append((name, status))
+    return dashboard
+
+
 # gets a user from the database 
 def get_sender(username: str):
     with Session(engine) as session:
@@ -121,18 +331,198 @@ def check_existing_request(sender_username: str, receiver_username: str):
         return existing_request
 
 
+# in-memory public key directory, maps the username to (fingerprint, public key)
+# users are loaded from the database the first time they are looked up,
+# after that save_public_key keeps the entry up to date in this process
+# entries expire after KEY_DIRECTORY_TTL seconds so keys saved by other worker processes show up
+KEY_DIRECTORY_TTL = float(os.environ.get("KEY_DIRECTORY_TTL", 5))
+key_directory = LRUCache("public_key", CACHE_SIZE, KEY_DIRECTORY_TTL)
+caches.append(key_directory)
+
+# short identifier of a public key, changes whenever the key does
+def key_fingerprint(public_key: Optional[str]) -> Optional[str]:
+    if public_key is None:
+        return None
+    return hashlib.sha256(public_key.encode()).hexdigest()[:32]
+
+
 def save_public_key(username: str, public_key: str):
     with Session(engine) as session:
         user = session.get(User, username)
         if user:
             user.public_key = public_key
             session.commit()
+            user_cache.invalidate(username)
         else:
             raise ValueError("User does not exist")
+    key_directory.invalidate(username)
+    key_directory.set(username, (key_fingerprint(public_key), public_key))
+
+
+# looks up (fingerprint, public key) for every username in one go
+# usernames that don't exist are left out of the result
+def get_key_entries(usernames) -> Dict[str, Tuple[Optional[str], Optional[str]]]:
+    entries = {}
+    missing = []
+    for username in usernames:
+        entry = key_directory.get(username, None)
+        if entry is not None:
+            entries[username] = entry
+        else:
+            missing.append(username)
+
+    if missing:
+        # a save_public_key that races with the query stops the stale rows being cached
+        generation = key_directory.generation
+        with Session(engine) as session:
+            rows = session.execute(select(User.username, User.public_key).where(User.username.in_(missing)))
+            for username, public_key in rows:
+                entries[username] = (key_fingerprint(public_key), public_key)
+                key_directory.set(username, entries[username], generation)
+    return entries
 
 
 def get_public_key(username: str):
+    entry = get_key_entries([username]).get(username)
+    return entry[1] if entry else None
+
+
+# chat messages are buffered and written in batches by a background thread
+# the seq of each message is worked out inside the INSERT, so writers never race on it
+MESSAGE_FLUSH_INTERVAL = float(os.environ.get("MESSAGE_FLUSH_INTERVAL", 0.05))
+MESSAGE_BATCH_SIZE = int(os.environ.get("MESSAGE_BATCH_SIZE", 256))
+# a batch that fails this many writes in a row is dropped, so one bad batch can't block the rest
+MESSAGE_WRITE_ATTEMPTS = int(os.environ.get("MESSAGE_WRITE_ATTEMPTS", 3))
+
+INSERT_MESSAGE = text(
+    "INSERT INTO message (conversation_id, seq, sender_id, ciphertext, created_at) "
+    "SELECT :conversation_id, coalesce(max(seq), 0) + 1, :sender_id, :ciphertext, :created_at "
+    "FROM message WHERE conversation_id = :conversation_id"
+)
+
+INSERT_MESSAGE_KEY = text(
+    "INSERT OR IGNORE INTO message_key (conversation_id, key_id, sender_id, ciphertext) "
+    "VALUES (:conversation_id, :key_id, :sender_id, :ciphertext)"
+)
+
+# the parts of the envelope format in static/js/chat_crypto.js the server reads,
+# the type byte and the key id after it, everything else stays opaque
+ENVELOPE_WITH_KEY = 1
+KEY_ID_LENGTH = 4
+
+# (envelope type, key id) of a ciphertext, None if it is too short to be an envelope
+def envelope_key(ciphertext: bytes) -> Optional[Tuple[int, bytes]]:
+    if len(ciphertext) <= 1 + KEY_ID_LENGTH:
+        return None
+    return ciphertext[0], ciphertext[1:1 + KEY_ID_LENGTH]
+
+class MessageWriter():
+    def __init__(self, flush_interval: float, batch_size: int):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = []
+        self.lock = Lock()
+        self.wake = Event()
+        self.thread = None
+        # failed writes in a row of the batch at the front of pending
+        self.failures = 0
+
+    # queues a message, it is written within flush_interval seconds
+    def append(self, conversation_id: str, sender_username: str, ciphertext: bytes):
+        with self.lock:
+            self.pending.append({
+                "conversation_id": conversation_id,
+                "sender_id": sender_username,
+                "ciphertext": ciphertext,
+                "created_at": time.time(),
+            })
+            full = len(self.pending) >= self.batch_size
+            if self.thread is None:
+                self.thread = Thread(target=self.run, name="message-writer", daemon=True)
+                self.thread.start()
+        if full:
+            self.wake.set()
+
+    # writes everything queued so far in one transaction
+    # a failed batch goes back to the front of the queue and is retried on the next flush
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if not batch:
+            return
+        # messages carrying a conversation key are also indexed by key id, see get_messages
+        keys = []
+        for message in batch:
+            envelope = envelope_key(message["ciphertext"])
+            if envelope is not None and envelope[0] == ENVELOPE_WITH_KEY:
+                keys.append(dict(message, key_id=envelope[1]))
+        try:
+            with engine.begin() as conn:
+                conn.execute(INSERT_MESSAGE, batch)
+                if keys:
+                    conn.execute(INSERT_MESSAGE_KEY, keys)
+        except Exception:
+            self.failures += 1
+            if self.failures < MESSAGE_WRITE_ATTEMPTS:
+                logger.exception("Writing %d messages failed, retrying", len(batch))
+                with self.lock:
+                    self.pending = batch + self.pending
+            else:
+                logger.exception("Writing %d messages failed %d times, dropping them", len(batch), self.failures)
+                self.failures = 0
+            return
+        self.failures = 0
+
+    def run(self):
+        while True:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            self.flush()
+
+message_writer = MessageWriter(MESSAGE_FLUSH_INTERVAL, MESSAGE_BATCH_SIZE)
+atexit.register(message_writer.flush)
+
+def save_message(username: str, friend_username: str, ciphertext: bytes):
+    message_writer.append(Message.conversation(username, friend_username), username, ciphertext)
+
+
+class MessagePage(NamedTuple):
+    # (seq, sender, ciphertext, created_at) rows, oldest first
+    messages: list
+    # pass this as before to get the next older page, None when there are no older messages
+    next_before: Optional[int]
+    # (sender, ciphertext) of the older messages that carried keys this page's messages use
+    keys: list
+
+# most messages returned in one page of history
+MAX_MESSAGE_PAGE = 200
+
+# one page of history, the newest messages when before is None
+# keyset pagination, so every page is a single range scan over the primary key
+def get_messages(username: str, friend_username: str, before: Optional[int] = None, limit: int = 50) -> MessagePage:
+    limit = max(1, min(limit, MAX_MESSAGE_PAGE))
+    query = select(Message.seq, Message.sender_id, Message.ciphertext, Message.created_at) \
+        .where(Message.conversation_id == Message.conversation(username, friend_username))
+    if before is not None:
+        query = query.where(Message.seq < before)
+    # one extra row tells us whether there is an older page
+    query = query.order_by(Message.seq.desc()).limit(limit + 1)
+
     with Session(engine) as session:
-        user = session.query(User).filter(User.username == username).one_or_none()
-        return user.public_key if user else None
+        rows = [tuple(row) for row in session.execute(query)]
+        next_before = rows[limit - 1][0] if len(rows) > limit else None
+        rows = rows[:limit][::-1]
 
+        # key ids used on this page whose key carrying message is on an older one
+        carried, used = set(), set()
+        for _, _, ciphertext, _ in rows:
+            envelope = envelope_key(ciphertext)
+            if envelope is not None:
+                (carried if envelope[0] == ENVELOPE_WITH_KEY else used).add(envelope[1])
+        keys = []
+        if used - carried:
+            keys = [tuple(row) for row in session.execute(
+                select(MessageKey.sender_id, MessageKey.ciphertext)
+                    .where(MessageKey.conversation_id == Message.conversation(username, friend_username),
+                           MessageKey.key_id.in_(used - carried)))]
+    return MessagePage(rows, next_before, keys)
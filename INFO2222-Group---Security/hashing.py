@@ -0,0 +1,231 @@
+'''
+hashing
+password hashing and verification, run in a pool of worker processes
+
+PBKDF2 keeps a core busy for a long time and holds the GIL while it does,
+running it on the request thread freezes every socket event served by the same process.
+Here the work runs in separate processes and the calling thread just waits for the result.
+At most MAX_IN_FLIGHT hashes are queued or running at once, callers past that wait
+up to QUEUE_TIMEOUT seconds for a slot and then get HashingBusy.
+
+The hashing scheme and its work factor are picked with PASSWORD_HASHER and PASSWORD_HASH_COST.
+Every stored hash records the scheme and parameters it was made with, so old hashes keep
+verifying after the settings change and can be upgraded the next time the user logs in.
+To pick a cost for this machine:
+    python hashing.py calibrate --target-ms 250
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+from threading import BoundedSemaphore, Lock
+import argparse
+import hashlib
+import hmac
+import os
+import sys
+import time
+
+from werkzeug.security import gen_salt, check_password_hash
+
+
+# pbkdf2:<digest>:<iterations>$<salt>$<hex>, the format werkzeug uses
+class PBKDF2Hasher():
+    name = "pbkdf2"
+    default_cost = 260000
+
+    def __init__(self, cost: int = default_cost, digest: str = "sha256"):
+        self.cost = cost
+        self.digest = digest
+
+    def prefix(self) -> str:
+        return f"pbkdf2:{self.digest}:{self.cost}"
+
+    def hash(self, password: str) -> str:
+        salt = gen_salt(16)
+        value = hashlib.pbkdf2_hmac(self.digest, password.encode(), salt.encode(), self.cost).hex()
+        return f"{self.prefix()}${salt}${value}"
+
+    def verify(self, password_hash: str, password: str) -> bool:
+        return check_password_hash(password_hash, password)
+
+    # a cost that takes about target seconds, PBKDF2 time grows linearly with iterations
+    @classmethod
+    def calibrate(cls, target: float) -> int:
+        probe = 50000
+        elapsed = time_hash(cls(probe))
+        return max(10000, round(probe * target / elapsed / 10000) * 10000)
+
+
+# scrypt:<n>:<r>:<p>$<salt>$<hex>, the format newer werkzeug versions use
+class ScryptHasher():
+    name = "scrypt"
+    default_cost = 2 ** 15
+
+    def __init__(self, cost: int = default_cost, r: int = 8, p: int = 1):
+        self.cost = cost
+        self.r = r
+        self.p = p
+
+    def prefix(self) -> str:
+        return f"scrypt:{self.cost}:{self.r}:{self.p}"
+
+    @staticmethod
+    def derive(password: str, salt: str, n: int, r: int, p: int) -> str:
+        return hashlib.scrypt(password.encode(), salt=salt.encode(), n=n, r=r, p=p,
+                              maxmem=132 * n * r * p, dklen=64).hex()
+
+    def hash(self, password: str) -> str:
+        salt = gen_salt(16)
+        return f"{self.prefix()}${salt}${self.derive(password, salt, self.cost, self.r, self.p)}"
+
+    def verify(self, password_hash: str, password: str) -> bool:
+        method, salt, value = password_hash.split("$", 2)
+        n, r, p = (int(part) for part in method.split(":")[1:])
+        return hmac.compare_digest(self.derive(password, salt, n, r, p), value)
+
+    # the largest power of two n that stays under target seconds
+    # raises ValueError when even the smallest n takes longer
+    @classmethod
+    def calibrate(cls, target: float) -> int:
+        n = 2 ** 12
+        if time_hash(cls(n)) > target:
+            raise ValueError(f"scrypt with n={n} already takes longer than {target * 1000:.0f}ms on this machine")
+        while time_hash(cls(n * 2)) <= target:
+            n *= 2
+        return n
+
+
+HASHERS = {hasher.name: hasher for hasher in (PBKDF2Hasher, ScryptHasher)}
+
+def time_hash(hasher) -> float:
+    start = time.perf_counter()
+    hasher.hash("calibration password")
+    return time.perf_counter() - start
+
+def make_hasher(name: str, cost=None):
+    if name not in HASHERS:
+        raise ValueError(f"Unknown password hasher: {name}")
+    hasher = HASHERS[name]
+    return hasher(int(cost) if cost else hasher.default_cost)
+
+# the hasher new hashes are made with
+hasher = make_hasher(os.environ.get("PASSWORD_HASHER", "pbkdf2"), os.environ.get("PASSWORD_HASH_COST"))
+
+
+HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+MAX_IN_FLIGHT = int(os.environ.get("PASSWORD_HASH_MAX_IN_FLIGHT", 4 * HASH_WORKERS))
+QUEUE_TIMEOUT = float(os.environ.get("PASSWORD_HASH_QUEUE_TIMEOUT", 30))
+
+
+class HashingBusy(Exception):
+    pass
+
+
+# the pool is only started the first time a password is hashed
+pool = None
+pool_lock = Lock()
+slots = BoundedSemaphore(MAX_IN_FLIGHT)
+
+metrics_lock = Lock()
+metrics = {
+    # waiting for a slot
+    "waiting": 0,
+    # holding a slot, queued in the pool or running in a worker
+    "in_flight": 0,
+    "completed": 0,
+    # raised in the worker, or the pool broke
+    "failed": 0,
+    "rejected": 0,
+}
+
+def get_pool() -> ProcessPoolExecutor:
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=HASH_WORKERS)
+        return pool
+
+def count(name: str, amount: int = 1):
+    with metrics_lock:
+        metrics[name] += amount
+
+# runs function in the pool, blocking only the calling thread
+def run(function, *args):
+    count("waiting")
+    acquired = slots.acquire(timeout=QUEUE_TIMEOUT)
+    count("waiting", -1)
+    if not acquired:
+        count("rejected")
+        raise HashingBusy("Too many password checks in progress")
+
+    count("in_flight")
+    try:
+        result = get_pool().submit(function, *args).result()
+    except Exception:
+        count("failed")
+        raise
+    finally:
+        slots.release()
+        count("in_flight", -1)
+    count("completed")
+    return result
+
+# like run, but returns a Future straight away instead of waiting for the result
+# returns None when every slot is taken, the slot is given back once the work is done
+def submit(function, *args):
+    if not slots.acquire(blocking=False):
+        count("rejected")
+        return None
+    count("in_flight")
+
+    def done(future):
+        slots.release()
+        count("in_flight", -1)
+        count("failed" if future.cancelled() or future.exception() is not None else "completed")
+
+    future = get_pool().submit(function, *args)
+    future.add_done_callback(done)
+    return future
+
+# checks a password against a hash made by any of the hashers
+def verify(password_hash: str, password: str) -> bool:
+    name = password_hash.split(":", 1)[0]
+    if name not in HASHERS or password_hash.count("$") < 2:
+        return False
+    return HASHERS[name]().verify(password_hash, password)
+
+# true when the hash wasn't made with the current hasher and cost
+def needs_rehash(password_hash: str) -> bool:
+    return not password_hash.startswith(hasher.prefix() + "$")
+
+def hash_password(password: str) -> str:
+    return run(hasher.hash, password)
+
+def verify_password(password_hash: str, password: str) -> bool:
+    return run(verify, password_hash, password)
+
+# queue depth and throughput counters
+def stats() -> dict:
+    with metrics_lock:
+        return dict(metrics, workers=HASH_WORKERS, max_in_flight=MAX_IN_FLIGHT)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    calibrate = commands.add_parser("calibrate", help="pick the work factor for a target hashing time")
+    calibrate.add_argument("--target-ms", type=float, default=250)
+    calibrate.add_argument("--hasher", choices=sorted(HASHERS), default=hasher.name)
+    args = parser.parse_args()
+
+    try:
+        cost = HASHERS[args.hasher].calibrate(args.target_ms / 1000)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    elapsed = min(time_hash(make_hasher(args.hasher, cost)) for _ in range(3))
+    print(f"{args.hasher} with cost {cost} takes {elapsed * 1000:.0f}ms on this machine, to use it set")
+    print(f"PASSWORD_HASHER={args.hasher} PASSWORD_HASH_COST={cost}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+'''
+migrations
+schema changes for databases that already exist
+
+Base.metadata.create_all only creates missing tables, it never changes a table
+or adds an index to a table that is already there. Each migration below is a list
+of SQL statements, applied in order to bring an existing database up to date.
+The number of migrations applied is stored in the database's PRAGMA user_version,
+so every migration only runs once per database.
+
+db.py runs this on import, to migrate a database file by hand:
+    python migrations.py database/main.db
+'''
+
+import argparse
+import sys
+
+from sqlalchemy import text
+
+
+MIGRATIONS = [
+    # 1: one friendship row per pair, smaller username first
+    # older databases stored every friendship twice, once in each direction
+    [
+        "INSERT OR IGNORE INTO friendship (user_id, friend_id) "
+        "SELECT min(user_id, friend_id), max(user_id, friend_id) FROM friendship "
+        "WHERE user_id > friend_id",
+        "DELETE FROM friendship WHERE user_id >= friend_id",
+        "CREATE INDEX IF NOT EXISTS ix_friendship_friend_user ON friendship (friend_id, user_id)",
+    ],
+    # 2: receiver side friend request lookups
+    # the primary key (sender_id, receiver_id) already serves lookups by sender
+    [
+        "CREATE INDEX IF NOT EXISTS ix_friend_request_receiver_status ON friend_request (receiver_id, status)",
+    ],
+]
+
+
+def get_version(conn) -> int:
+    return conn.execute(text("PRAGMA user_version")).scalar()
+
+# applies every migration the database hasn't had yet, each in its own transaction
+# returns the list of migration numbers that were applied
+def migrate(engine):
+    applied = []
+    for number, statements in enumerate(MIGRATIONS, start=1):
+        with engine.begin() as conn:
+            if get_version(conn) >= number:
+                continue
+            for statement in statements:
+                conn.execute(text(statement))
+            # pragmas can't take bound parameters
+            conn.execute(text(f"PRAGMA user_version = {number}"))
+        applied.append(number)
+    return applied
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("database", nargs="?", default="database/main.db")
+    args = parser.parse_args()
+
+    from sqlalchemy import create_engine
+    from models import Base
+
+    engine = create_engine(f"sqlite:///{args.database}")
+    Base.metadata.create_all(engine)
+    applied = migrate(engine)
+    if applied:
+        print(f"applied migrations {', '.join(map(str, applied))}, now at version {len(MIGRATIONS)}")
+    else:
+        print(f"already at version {len(MIGRATIONS)}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,12 +13,16 @@ or use SQLite, if you're not into fancy ORMs (but be mindful of Injection attack
 from sqlalchemy import String
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey
+from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, CheckConstraint, Index, LargeBinary, Float
 from sqlalchemy.orm import declarative_base, Session, relationship
 
 from collections import defaultdict
-from typing import Dict, Set
-from werkzeug.security import generate_password_hash, check_password_hash
+from typing import Dict, Optional, Set, Tuple
+import hashing
+import hashlib
+import threading
+
+from sqlite_store import SqliteStore
 
 
 
@@ -37,26 +41,50 @@ class User(Base):
     # in other words we've mapped the username Python object property to an SQL column of type String 
     username: Mapped[str] = mapped_column(String, primary_key=True)
     password: Mapped[str] = mapped_column(String)
-    public_key: Mapped[str] = mapped_column(String)
+    public_key: Mapped[Optional[str]] = mapped_column(String)
     
+    # both run in the hashing process pool, see hashing.py
     def set_password(self, password):
-        self.password = generate_password_hash(password)
+        self.password = hashing.hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password, password)
+        return hashing.verify_password(self.password, password)
+
+    # true when the stored hash was made with an older scheme or cost
+    def needs_rehash(self):
+        return hashing.needs_rehash(self.password)
 
 
 
+# one row per friendship, the smaller username is always stored in user_id
+# the primary key serves lookups by user_id and ix_friendship_friend_user serves
+# lookups by friend_id, both indexes hold both columns so neither touches the table
 class Friendship(Base):
     __tablename__ = 'friendship'
     user_id = Column(String, ForeignKey('user.username'), primary_key=True)
     friend_id = Column(String, ForeignKey('user.username'), primary_key=True)
+    __table_args__ = (
+        CheckConstraint('user_id < friend_id', name='ck_friendship_canonical'),
+        Index('ix_friendship_friend_user', 'friend_id', 'user_id'),
+    )
+
+    @staticmethod
+    def pair(username: str, friend_username: str):
+        """ Returns the (user_id, friend_id) order a friendship is stored in. """
+        if username < friend_username:
+            return username, friend_username
+        return friend_username, username
 
 class FriendRequest(Base):
     __tablename__ = 'friend_request'
     sender_id = Column(String, ForeignKey('user.username'), primary_key=True)
     receiver_id = Column(String, ForeignKey('user.username'), primary_key=True)
     status = Column(String, nullable=False)
+    # lookups by sender use the primary key, this serves the receiver side
+    __table_args__ = (
+        Index('ix_friend_request_receiver_status', 'receiver_id', 'status'),
+    )
+
     def __repr__(self):
         return f"<Frie  ndRequest(sender_id={self.sender_id}, receiver_id={self.receiver_id}, status={self.status})>"
 
@@ -68,56 +96,201 @@ class FriendRequest(Base):
 
 
 
+# chat history, one row per message
+# the primary key (conversation_id, seq) is the only index, and the table is stored
+# in primary key order (WITHOUT ROWID) so a page of history is one range scan
+class Message(Base):
+    __tablename__ = 'message'
+    conversation_id = Column(String, primary_key=True)
+    # position of the message in its conversation, starting at 1
+    seq = Column(Integer, primary_key=True)
+    sender_id = Column(String, ForeignKey('user.username'), nullable=False)
+    ciphertext = Column(LargeBinary, nullable=False)
+    # unix time the server received the message
+    created_at = Column(Float, nullable=False)
+    __table_args__ = {'sqlite_with_rowid': False}
 
-# stateful counter used to generate the room id
-class Counter():
-    def __init__(self):
-        self.counter = 0
-    
-    def get(self):
-        self.counter += 1
-        return self.counter
+    @staticmethod
+    def conversation(username: str, friend_username: str) -> str:
+        """ Returns the conversation id shared by both users. """
+        # \x1f can't be typed into a username box, so ids never collide
+        return "\x1f".join(Friendship.pair(username, friend_username))
+
+# the message that carried each conversation key, see static/js/chat_crypto.js
+# only the first message under a key carries it, so a page of history that doesn't reach
+# back that far gets the key carrying messages it needs from here
+class MessageKey(Base):
+    __tablename__ = 'message_key'
+    conversation_id = Column(String, primary_key=True)
+    key_id = Column(LargeBinary, primary_key=True)
+    sender_id = Column(String, ForeignKey('user.username'), nullable=False)
+    ciphertext = Column(LargeBinary, nullable=False)
+    __table_args__ = {'sqlite_with_rowid': False}
+
+
+# room id of the conversation between two users
+# derived from the sorted pair, so it is the same in every process and after a restart
+# 52 bits so it stays an exact integer in JavaScript
+def pair_room_id(username: str, friend_username: str) -> int:
+    digest = hashlib.sha256("\x1f".join(Friendship.pair(username, friend_username)).encode()).digest()
+    return int.from_bytes(digest[:8], "big") >> 12
+
+# one socket.io room, a conversation between two participants
+# users holds the participants that are currently in the room
+class RoomRecord():
+    __slots__ = ("room_id", "participants", "users")
 
-# Room class, used to keep track of which username is in which room
+    def __init__(self, room_id: int, participants: Tuple[str, str]):
+        self.room_id = room_id
+        self.participants = participants
+        self.users: Set[str] = set()
+
+# Room class, keeps track of which users are in which rooms
+# every lookup, join and leave is a dict or set operation, and a user can be in any number of rooms
+# socket handlers run on many threads, so every change happens under one lock
 class Room():
     def __init__(self):
-        self.counter = Counter()
-        # dictionary that maps the username to the room id
-        # for example self.dict["John"] -> gives you the room id of 
-        # the room where John is in
-        self.dict: Dict[str, int] = {}
-        self.room_users: Dict[int, Set[str]] = defaultdict(set)
+        # maps the room id to its record
+        self.rooms: Dict[int, RoomRecord] = {}
+        # maps the username to the ids of every room the user is in
+        self.user_rooms: Dict[str, Set[int]] = defaultdict(set)
+        self.lock = threading.Lock()
 
+    # creates the room for a conversation, with sender already in it
+    # if both users create it at once, the second one just joins the first one's room
     def create_room(self, sender: str, receiver: str) -> int:
-        room_id = self.counter.get()
-        self.dict[sender] = room_id
-        self.dict[receiver] = room_id
-        #self.room_users[room_id].update({sender, receiver})  # Adding both users to the set of the room
+        room_id = pair_room_id(sender, receiver)
+        with self.lock:
+            self.rooms.setdefault(room_id, RoomRecord(room_id, Friendship.pair(sender, receiver)))
+            self.add_user(sender, room_id)
         return room_id
-    
-    def join_room(self,  username: str, room_id: int) -> int:
-        self.dict[username] = room_id
-        self.room_users[room_id].add(username)
-
-    def leave_room(self, username):
-        if username in self.dict:
-            room_id = self.dict[username]
-            self.room_users[room_id].remove(username)
-            if not self.room_users[room_id]:
-                del self.room_users[room_id]
-            del self.dict[username]
-
-    # gets the room id from a user
-    def get_room_id(self, user: str):
-        if user not in self.dict.keys():
-            return None
-        return self.dict[user]
-    
+
+    def join_room(self, username: str, room_id: int):
+        with self.lock:
+            self.add_user(username, room_id)
+
+    # callers hold the lock
+    def add_user(self, username: str, room_id: int):
+        self.rooms[room_id].users.add(username)
+        self.user_rooms[username].add(room_id)
+
+    # leaves one room, or every room the user is in when room_id is None
+    # rooms are removed once the last user leaves
+    def leave_room(self, username: str, room_id: Optional[int] = None):
+        with self.lock:
+            room_ids = [room_id] if room_id is not None else list(self.user_rooms.get(username, ()))
+            for room_id in room_ids:
+                record = self.rooms.get(room_id)
+                if record is None:
+                    continue
+                record.users.discard(username)
+                if not record.users:
+                    del self.rooms[room_id]
+
+                user_rooms = self.user_rooms.get(username)
+                if user_rooms is not None:
+                    user_rooms.discard(room_id)
+                    if not user_rooms:
+                        del self.user_rooms[username]
+
+    # gets the id of the room for a conversation between the two users
+    def get_room_id(self, user: str, other: str) -> Optional[int]:
+        room_id = pair_room_id(user, other)
+        return room_id if room_id in self.rooms else None
+
+    # copies, so callers can iterate while other threads join and leave
+    def get_user_rooms(self, user: str) -> Set[int]:
+        with self.lock:
+            return set(self.user_rooms.get(user, ()))
+
     def get_room_users(self, room_id: int) -> Set[str]:
-        return self.room_users.get(room_id, set())
+        with self.lock:
+            record = self.rooms.get(room_id)
+            return set(record.users) if record is not None else set()
+
+    def get_participants(self, room_id: int) -> Optional[Tuple[str, str]]:
+        record = self.rooms.get(room_id)
+        return record.participants if record is not None else None
 
     def can_chat(self, room_id: int) -> bool:
         """ Check if the room has more than one user to enable chat. """
-        print(len(self.room_users[room_id]))
-        return len(self.room_users[room_id]) > 1
-    
+        return len(self.get_room_users(room_id)) > 1
+
+
+# Room backed by a SQLite file in WAL mode, same interface as Room
+# every process using the same file sees the same rooms, so socket workers can share them
+class SqliteRoom(SqliteStore):
+    def __init__(self, path: str):
+        super().__init__(path)
+        conn = self.connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS room ("
+            "room_id INTEGER PRIMARY KEY, user_a TEXT NOT NULL, user_b TEXT NOT NULL)"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS room_member ("
+            "room_id INTEGER NOT NULL, username TEXT NOT NULL, PRIMARY KEY (room_id, username)"
+            ") WITHOUT ROWID"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_room_member_username ON room_member (username, room_id)")
+
+    # one transaction, so another process's leave_room can't delete the room between
+    # the two inserts and leave a member row without its room
+    def create_room(self, sender: str, receiver: str) -> int:
+        room_id = pair_room_id(sender, receiver)
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR IGNORE INTO room (room_id, user_a, user_b) VALUES (?, ?, ?)",
+                (room_id, *Friendship.pair(sender, receiver)),
+            )
+            self.join_room(sender, room_id)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return room_id
+
+    def join_room(self, username: str, room_id: int):
+        self.connect().execute("INSERT OR IGNORE INTO room_member (room_id, username) VALUES (?, ?)", (room_id, username))
+
+    def leave_room(self, username: str, room_id: Optional[int] = None):
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if room_id is None:
+                room_ids = [row[0] for row in conn.execute(
+                    "SELECT room_id FROM room_member WHERE username = ?", (username,))]
+            else:
+                room_ids = [room_id]
+            for room_id in room_ids:
+                conn.execute("DELETE FROM room_member WHERE room_id = ? AND username = ?", (room_id, username))
+                conn.execute(
+                    "DELETE FROM room WHERE room_id = ? AND NOT EXISTS "
+                    "(SELECT 1 FROM room_member WHERE room_id = ?)", (room_id, room_id))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def get_room_id(self, user: str, other: str) -> Optional[int]:
+        room_id = pair_room_id(user, other)
+        row = self.connect().execute("SELECT 1 FROM room WHERE room_id = ?", (room_id,)).fetchone()
+        return room_id if row else None
+
+    def get_user_rooms(self, user: str) -> Set[int]:
+        return {row[0] for row in self.connect().execute(
+            "SELECT room_id FROM room_member WHERE username = ?", (user,))}
+
+    def get_room_users(self, room_id: int) -> Set[str]:
+        return {row[0] for row in self.connect().execute(
+            "SELECT username FROM room_member WHERE room_id = ?", (room_id,))}
+
+    def get_participants(self, room_id: int) -> Optional[Tuple[str, str]]:
+        row = self.connect().execute("SELECT user_a, user_b FROM room WHERE room_id = ?", (room_id,)).fetchone()
+        return tuple(row) if row else None
+
+    def can_chat(self, room_id: int) -> bool:
+        """ Check if the room has more than one user to enable chat. """
+        return len(self.get_room_users(room_id)) > 1
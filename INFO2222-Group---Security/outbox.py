@@ -0,0 +1,77 @@
+'''
+outbox
+optional per-room buffering of outgoing chat messages
+
+Without it every "send" event turns into one "incoming_ciphertext" frame per recipient.
+With it, messages for a room are collected and sent as one "incoming_batch" event
+holding a list of messages, either every flush_interval seconds or as soon as
+batch_size messages are waiting, whichever comes first. Messages keep their order.
+
+A batch that can't be sent, say because the message queue is down, stays queued
+and is tried again on the next flush, up to send_attempts times in a row.
+'''
+
+from threading import Lock
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox():
+    def __init__(self, socketio, flush_interval: float = 0.005, batch_size: int = 32, send_attempts: int = 3):
+        self.socketio = socketio
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        # maps the room id to the messages waiting to be sent to it
+        self.rooms = {}
+        self.lock = Lock()
+        self.started = False
+        self.send_attempts = send_attempts
+        # maps the room id to how many times in a row sending to it failed
+        self.failures = {}
+
+    # queues a message for the room, sending the batch straight away if it is full
+    # batches are emitted while holding the lock so a room's batches can't overtake each other
+    def post(self, room_id, message):
+        with self.lock:
+            if not self.started:
+                self.started = True
+                self.socketio.start_background_task(self.run)
+            queue = self.rooms.setdefault(room_id, [])
+            queue.append(message)
+            if len(queue) >= self.batch_size:
+                del self.rooms[room_id]
+                self.send(room_id, queue)
+
+    # sends everything waiting, one event per room
+    def flush(self):
+        with self.lock:
+            rooms, self.rooms = self.rooms, {}
+            for room_id, queue in rooms.items():
+                self.send(room_id, queue)
+
+    # emits one batch, called with the lock held
+    # a failed batch goes back in front of anything queued for the room since
+    def send(self, room_id, queue):
+        try:
+            self.socketio.emit("incoming_batch", queue, to=room_id)
+        except Exception:
+            failures = self.failures.get(room_id, 0) + 1
+            if failures < self.send_attempts:
+                logger.exception("Sending %d messages to room %s failed, retrying", len(queue), room_id)
+                self.failures[room_id] = failures
+                self.rooms[room_id] = queue + self.rooms.get(room_id, [])
+            else:
+                logger.exception("Sending %d messages to room %s failed %d times, dropping them",
+                                 len(queue), room_id, failures)
+                self.failures.pop(room_id, None)
+            return
+        self.failures.pop(room_id, None)
+
+    def run(self):
+        while True:
+            self.socketio.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Flushing the outbox failed")
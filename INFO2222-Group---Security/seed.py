@@ -0,0 +1,130 @@
+'''
+seed
+generates a synthetic social graph and bulk loads it into the database
+so the app can be tried at production scale locally
+
+friendships follow a power law (preferential attachment, a few users have lots of friends
+and most users have a handful), a share of the edges are left as pending friend requests
+user i gets the password "password{i % distinct_passwords}" so you can log in as anyone
+
+for example, a million users into a scratch database:
+    python seed.py --users 1000000 --db database/seed.db
+'''
+
+import argparse
+import base64
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import hashing
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10000, help="number of users to create")
+    parser.add_argument("--db", default="database/main.db", help="database file to load into")
+    parser.add_argument("--prefix", default="user", help="usernames are prefix + number")
+    parser.add_argument("--edges-per-user", type=int, default=5,
+                        help="edges each new user attaches with, the mean degree is about twice this")
+    parser.add_argument("--pending", type=float, default=0.1, help="share of edges left as pending requests")
+    parser.add_argument("--keys", type=float, default=1.0, help="share of users given a public key")
+    parser.add_argument("--distinct-passwords", type=int, default=1000,
+                        help="hashing a million passwords takes days, users share this many hashes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes used for password hashing")
+    parser.add_argument("--batch-size", type=int, default=50000, help="rows per executemany")
+    parser.add_argument("--seed", type=int, default=2222)
+    return parser.parse_args()
+
+
+# barabasi-albert style preferential attachment
+# yields (new user, existing user) pairs, every pair is unique
+def power_law_edges(users: int, edges_per_user: int, rng: random.Random):
+    # the first few users all know each other
+    seed_users = min(users, edges_per_user + 1)
+    # every endpoint of every edge so far, picking from it favours well connected users
+    endpoints = []
+    for user in range(seed_users):
+        for other in range(user):
+            yield user, other
+            endpoints += (user, other)
+
+    for user in range(seed_users, users):
+        targets = set()
+        while len(targets) < edges_per_user:
+            targets.add(rng.choice(endpoints))
+        for target in targets:
+            yield user, target
+            endpoints.append(target)
+            endpoints.append(user)
+
+
+# fake SubjectPublicKeyInfo sized like a real RSA-2048 key, base64 encoded like the client sends it
+def fake_public_key(rng: random.Random) -> str:
+    return base64.b64encode(rng.randbytes(294)).decode()
+
+
+def batches(rows, size: int):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+
+    # db.py reads DB_URL when it is imported
+    os.environ["DB_URL"] = f"sqlite:///{args.db}"
+    import db
+    from models import User, Friendship, FriendRequest
+    from sqlalchemy import insert
+
+    start = time.perf_counter()
+    passwords = [f"password{i}" for i in range(min(args.distinct_passwords, args.users))]
+    with ProcessPoolExecutor(args.workers) as pool:
+        # the app's current hasher, so seeded users don't all need a rehash on their first login
+        hashes = list(pool.map(hashing.hasher.hash, passwords, chunksize=max(1, len(passwords) // (args.workers * 4))))
+    print(f"hashed {len(hashes)} passwords in {time.perf_counter() - start:.1f}s")
+
+    def name(i):
+        return f"{args.prefix}{i}"
+
+    def user_rows():
+        for i in range(args.users):
+            yield {
+                "username": name(i),
+                "password": hashes[i % len(hashes)],
+                "public_key": fake_public_key(rng) if rng.random() < args.keys else None,
+            }
+
+    friendships = []
+    requests = []
+    for user, other in power_law_edges(args.users, args.edges_per_user, rng):
+        if rng.random() < args.pending:
+            requests.append({"sender_id": name(user), "receiver_id": name(other), "status": "pending"})
+        else:
+            user_id, friend_id = Friendship.pair(name(user), name(other))
+            friendships.append({"user_id": user_id, "friend_id": friend_id})
+    print(f"generated {len(friendships)} friendships and {len(requests)} pending requests "
+          f"in {time.perf_counter() - start:.1f}s")
+
+    # one transaction for the whole load, one executemany per batch
+    with db.engine.begin() as conn:
+        for table, rows in ((User, user_rows()), (Friendship, friendships), (FriendRequest, requests)):
+            loaded = 0
+            for batch in batches(rows, args.batch_size):
+                conn.execute(insert(table), batch)
+                loaded += len(batch)
+            print(f"loaded {loaded} {table.__tablename__} rows, {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
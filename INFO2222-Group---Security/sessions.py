@@ -0,0 +1,171 @@
+'''
+sessions
+server side session storage, picked with the SESSION_TYPE config value
+
+"memory"      sessions live in a dict in this process, for single process deployments
+"sqlite"      sessions live in a SQLite file in WAL mode, shared by every local process
+"filesystem"  the old flask_session backend, one pickled file per session
+
+The cookie only holds a random session id. Sessions expire SESSION_TTL seconds after
+they were last saved, and a background thread removes expired ones in bulk every
+SESSION_SWEEP_INTERVAL seconds. Empty sessions are never stored.
+'''
+
+from threading import Lock, Thread
+import secrets
+import time
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
+
+from sqlite_store import SqliteStore
+
+
+serializer = TaggedJSONSerializer()
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(session):
+            session.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+
+
+# keeps every session in a dict, maps the session id to (expiry time, data)
+class MemorySessionStore():
+    def __init__(self):
+        self.sessions = {}
+        self.lock = Lock()
+
+    def get(self, sid: str):
+        entry = self.sessions.get(sid)
+        if entry is None or entry[0] < time.time():
+            return None
+        return entry[1]
+
+    def set(self, sid: str, data: dict, ttl: float):
+        with self.lock:
+            self.sessions[sid] = (time.time() + ttl, data)
+
+    def delete(self, sid: str):
+        with self.lock:
+            self.sessions.pop(sid, None)
+
+    # removes every expired session, returns how many were removed
+    def sweep(self) -> int:
+        now = time.time()
+        with self.lock:
+            expired = [sid for sid, (expires, _) in self.sessions.items() if expires < now]
+            for sid in expired:
+                del self.sessions[sid]
+        return len(expired)
+
+    def __len__(self):
+        return len(self.sessions)
+
+
+# keeps every session in one SQLite table, ordered by session id with an index on the expiry time
+class SqliteSessionStore(SqliteStore):
+    def __init__(self, path: str):
+        super().__init__(path)
+        conn = self.connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS session ("
+            "sid TEXT PRIMARY KEY, expires REAL NOT NULL, data TEXT NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_session_expires ON session (expires)")
+
+    def get(self, sid: str):
+        row = self.connect().execute(
+            "SELECT data FROM session WHERE sid = ? AND expires >= ?", (sid, time.time())
+        ).fetchone()
+        return serializer.loads(row[0]) if row else None
+
+    def set(self, sid: str, data: dict, ttl: float):
+        self.connect().execute(
+            "INSERT OR REPLACE INTO session (sid, expires, data) VALUES (?, ?, ?)",
+            (sid, time.time() + ttl, serializer.dumps(data)),
+        )
+
+    def delete(self, sid: str):
+        self.connect().execute("DELETE FROM session WHERE sid = ?", (sid,))
+
+    def sweep(self) -> int:
+        return self.connect().execute("DELETE FROM session WHERE expires < ?", (time.time(),)).rowcount
+
+    def __len__(self):
+        return self.connect().execute("SELECT count(*) FROM session").fetchone()[0]
+
+
+class ServerSideSessionInterface(SessionInterface):
+    def __init__(self, store, ttl: float):
+        self.store = store
+        self.ttl = ttl
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.get(sid)
+            if data is not None:
+                return ServerSideSession(data, sid=sid)
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified and not session.new:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        if not self.should_set_cookie(app, session):
+            return
+        self.store.set(session.sid, dict(session), self.ttl)
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+# removes expired sessions every interval seconds, for as long as the process runs
+def start_sweeper(store, interval: float) -> Thread:
+    def sweep_forever():
+        while True:
+            time.sleep(interval)
+            store.sweep()
+    thread = Thread(target=sweep_forever, name="session-sweeper", daemon=True)
+    thread.start()
+    return thread
+
+
+# sets up the session backend named by SESSION_TYPE on the app
+def init_app(app):
+    session_type = app.config.get("SESSION_TYPE", "memory")
+    if session_type == "filesystem":
+        from flask_session import Session
+        Session(app)
+        return
+
+    if session_type == "memory":
+        store = MemorySessionStore()
+    elif session_type == "sqlite":
+        store = SqliteSessionStore(app.config.get("SESSION_SQLITE_PATH", "database/sessions.db"))
+    else:
+        raise ValueError(f"Unknown session type: {session_type}")
+
+    app.session_interface = ServerSideSessionInterface(store, app.config.get("SESSION_TTL", 24 * 60 * 60))
+    start_sweeper(store, app.config.get("SESSION_SWEEP_INTERVAL", 60))
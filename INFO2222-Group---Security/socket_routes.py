@@ -5,94 +5,216 @@ file containing all the routes related to socket.io
 
 from flask_socketio import join_room, emit, leave_room
 from flask import request
+from typing import Optional
 
 
 try:
-    from __main__ import socketio
+    from __main__ import socketio, app
 except ImportError:
-    from app import socketio
+    from app import socketio, app
 
-from models import Room
+from models import Room, SqliteRoom, pair_room_id
+from outbox import Outbox
 
+import auth
 import db
 
-room = Room()
+# the room registry, shared between worker processes when it is backed by sqlite
+if app.config['ROOM_REGISTRY'] == 'sqlite':
+    room = SqliteRoom(app.config['ROOM_REGISTRY_PATH'])
+else:
+    room = Room()
+
+# buffers outgoing chat messages per room when batching is turned on
+outbox = None
+if app.config['OUTBOUND_BATCHING']:
+    outbox = Outbox(socketio, app.config['OUTBOUND_FLUSH_MS'] / 1000, app.config['OUTBOUND_BATCH_SIZE'])
+
+# who is behind a socket and which rooms it is in
+# worked out once in connect, so later events never have to ask the database
+class SocketContext():
+    __slots__ = ("username", "rooms")
+
+    def __init__(self, username: str):
+        self.username = username
+        self.rooms = set()
+
+# maps request.sid to the SocketContext of every connected socket
+contexts = {}
+
+# the context of the socket that sent the current event, if it is acting as username
+# events carrying someone else's username are spoofed and get None
+def identity(username):
+    context = contexts.get(request.sid)
+    if context is None or context.username != username:
+        return None
+    return context
+
+# the client sends ciphertext as a binary attachment, which arrives as bytes
+# older pages sent a list of byte values, those are still accepted
+# anything else, or more than MAX_CIPHERTEXT_BYTES, gives None
+def to_bytes(message) -> Optional[bytes]:
+    limit = app.config['MAX_CIPHERTEXT_BYTES']
+    if isinstance(message, (bytes, bytearray)):
+        return bytes(message) if 0 < len(message) <= limit else None
+    if isinstance(message, list) and 0 < len(message) <= limit \
+            and all(type(value) is int and 0 <= value < 256 for value in message):
+        return bytes(message)
+    return None
+
+# tells the sockets in username's rooms that username stored a new public key
+# so pages drop the key they imported instead of polling for changes
+# friend's conversation room is included even when username isn't in it any more
+def announce_key(username: str, fingerprint, friend=None):
+    room_ids = set(room.get_user_rooms(username))
+    if friend is not None:
+        room_ids.add(pair_room_id(username, friend))
+    for room_id in room_ids:
+        socketio.emit("key_rotated", {"username": username, "fingerprint": fingerprint}, to=room_id)
 
 # when the client connects to a socket
 # this event is emitted when the io() function is called in JS
 @socketio.on('connect')
 def connect():
-    username = request.cookies.get("username")
+    # with login tokens the identity comes from the signed token, not the plain cookie
+    if auth.enabled:
+        username = auth.current_user()
+    else:
+        username = request.cookies.get("username")
+        if username is not None and db.get_user(username) is None:
+            username = None
+    if username is None:
+        return False
+
+    context = SocketContext(username)
+    contexts[request.sid] = context
+
     room_id = request.cookies.get("room_id")
-    if room_id is None or username is None:
+    if room_id is None or not room_id.isdigit():
         return
     # socket automatically leaves a room on client disconnect
     # so on client connect, the room needs to be rejoined
-    join_room(int(room_id))
-    emit("incoming", (f"{username} has connected", "green"), to=int(room_id))
+    # room ids can be worked out by anyone, so only a participant of the room may rejoin it
+    room_id = int(room_id)
+    participants = room.get_participants(room_id)
+    if participants is None or username not in participants:
+        return
+    # disconnect took the user out of the room, so they are put back in
+    friend = participants[1] if participants[0] == username else participants[0]
+    room.create_room(username, friend)
+    join_room(room_id)
+    context.rooms.add(room_id)
+    emit("incoming", (f"{username} has connected", "green"), to=room_id)
 
 # event when client disconnects
 # quite unreliable use sparingly
 @socketio.on('disconnect')
 def disconnect():
-    username = request.cookies.get("username")
-    room_id = request.cookies.get("room_id")
-    if room_id is None or username is None:
+    context = contexts.pop(request.sid, None)
+    if context is None:
         return
-    emit("incoming", (f"{username} has disconnected", "red"), to=int(room_id))
+    for room_id in context.rooms:
+        emit("incoming", (f"{context.username} has disconnected", "red"), to=room_id)
+        # the user stays in the room while another of their sockets here is still in it
+        # sockets on other workers aren't known here, they rejoin when they reconnect
+        if any(other.username == context.username and room_id in other.rooms for other in list(contexts.values())):
+            continue
+        room.leave_room(context.username, room_id)
+        emit("chat_disabled", {"status": False}, to=room_id)
         
 
 # send message event handler
 @socketio.on("send")
 def send(username, message, room_id):
-
-    emit("incoming", (f"{username}: {message}"), to=room_id)
+    context = identity(username)
+    if context is None or room_id not in context.rooms:
+        return "Not in this room!"
+
+    ciphertext = to_bytes(message)
+    if ciphertext is None:
+        return "Invalid message!"
+    pair = room.get_participants(room_id)
+    if pair is not None and username in pair:
+        friend = pair[1] if pair[0] == username else pair[0]
+        db.save_message(username, friend, ciphertext)
+
+    # the bytes go out as a binary attachment again, so they are never turned into text
+    incoming = {"sender": username, "ciphertext": ciphertext}
+    if outbox is not None:
+        outbox.post(room_id, incoming)
+    else:
+        emit("incoming_ciphertext", incoming, to=room_id)
     
 # join room event handler
 # sent when the user joins a room
 @socketio.on("join")
 def join(sender_name, receiver_name):
     
-    receiver = db.get_user(receiver_name)
-    if receiver is None:
+    # the sender was checked when the socket connected
+    context = identity(sender_name)
+    if context is None:
+        return "Unknown sender!"
+
+    # one IN query for both users, the sender is normally already cached from connect
+    users = db.get_users((sender_name, receiver_name))
+    if users[receiver_name] is None:
         return "Unknown receiver!"
-    
-    sender = db.get_user(sender_name)
-    if sender is None:
+    if users[sender_name] is None:
         return "Unknown sender!"
 
-    room_id = room.get_room_id(receiver_name)
-    
+    existed = room.get_room_id(sender_name, receiver_name) is not None
+    # create_room joins the room when it exists, and makes it again if the last user
+    # left since the check above, so the sender is never added to a room that is gone
+    room_id = room.create_room(sender_name, receiver_name)
+    join_room(room_id)
+    context.rooms.add(room_id)
 
-    # if the user is already inside of a room 
-    if room_id is not None:
-        room.join_room(sender_name, room_id)
-        join_room(room_id)
+    # if the other user is already inside of the room for this conversation
+    if existed:
         # emit to everyone in the room except the sender
         emit("incoming", (f"{sender_name} has joined the room.", "green"), to=room_id, include_self=False)
         # emit only to the sender
         emit("incoming", (f"{sender_name} has joined the room. Now talking to {receiver_name}.", "green"))
-        emit("chat_enabled", {"status": True}, room=room_id)
+        if room.can_chat(room_id):
+            emit("chat_enabled", {"status": True}, room=room_id)
         return room_id
 
-    # if the user isn't inside of any room, 
-    # perhaps this user has recently left a room
-    # or is simply a new user looking to chat with someone
-    room_id = room.create_room(sender_name, receiver_name)
-    join_room(room_id)
+    # if there isn't a room for this conversation yet, 
+    # perhaps both users have recently left
+    # or this is simply the first time they chat
     if room.can_chat(room_id):
         emit("chat_enabled", {"status": True}, to=room_id)
     else:
         emit("chat_disabled", {"status": False}, to=room_id)
-    emit("incoming", (f"{sender_name} has joined the room. Now talking to memek {receiver_name}.", "green"), to=room_id)
+    emit("incoming", (f"{sender_name} has joined the room. Now talking to {receiver_name}.", "green"), to=room_id)
     return room_id
 
+# history event handler
+# returns one page of the conversation, pass the returned "before" back to get older messages
+@socketio.on("history")
+def history(username, friend, before=None, limit=50):
+    if identity(username) is None:
+        return "Not allowed!"
+    page = db.get_messages(username, friend, before, int(limit))
+    return {
+        "messages": [
+            {"seq": seq, "sender": sender, "ciphertext": ciphertext, "created_at": created_at}
+            for seq, sender, ciphertext, created_at in page.messages
+        ],
+        "keys": [{"sender": sender, "ciphertext": ciphertext} for sender, ciphertext in page.keys],
+        "before": page.next_before,
+    }
+
 # leave room event handler
 @socketio.on("leave")
 def leave(username, room_id):
+    context = identity(username)
+    if context is None or room_id not in context.rooms:
+        return
+    context.rooms.discard(room_id)
     emit("incoming", (f"{username} has left the room.", "red"), to=room_id)
     leave_room(room_id)
-    room.leave_room(username)
+    room.leave_room(username, room_id)
     emit("chat_disabled", {"status": False}, to=room_id)
 
 
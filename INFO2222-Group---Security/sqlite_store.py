@@ -0,0 +1,27 @@
+'''
+sqlite_store
+base for the stores that keep their own SQLite file in WAL mode next to the main database,
+the session store in sessions.py and the room registry in models.py,
+so every local process sees the same data
+'''
+
+from threading import local
+import sqlite3
+
+
+class SqliteStore():
+    def __init__(self, path: str):
+        self.path = path
+        # one connection per thread, sqlite3 connections can't be shared between threads
+        # a thread's connection is closed when the thread ends
+        self.local = local()
+
+    # this thread's connection, in autocommit mode, transactions are begun explicitly
+    def connect(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
@@ -0,0 +1,118 @@
+/*
+    chat_crypto.js
+    end to end encryption for chat messages, shared by home.jinja and the crypto benchmark page
+
+    Messages used to be encrypted with RSA-OAEP directly, which is slow, makes every
+    message 256 bytes and can't take more than 190 bytes of text.
+    Now each conversation has its own AES-GCM key. The key is wrapped once with the
+    recipient's RSA public key and every message after that is encrypted with AES-GCM.
+
+    A message is one of two envelopes, the header is authenticated as additional data:
+        [1][key id: 4 bytes][wrapped key length: 2 bytes][wrapped key][iv: 12 bytes][AES-GCM ciphertext]
+        [2][key id: 4 bytes][iv: 12 bytes][AES-GCM ciphertext]
+    The first message of a conversation key carries the wrapped key, the rest only its id.
+*/
+
+const ENVELOPE_WITH_KEY = 1;
+const ENVELOPE_MESSAGE = 2;
+const KEY_ID_LENGTH = 4;
+const IV_LENGTH = 12;
+
+const RSA_PARAMS = { name: "RSA-OAEP", hash: { name: "SHA-256" } };
+
+function base64_to_bytes(base64) {
+    const binary = atob(base64);
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i++) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    return bytes;
+}
+
+// the recipient's base64 spki public key, for wrapping conversation keys
+function import_public_key(base64) {
+    return crypto.subtle.importKey("spki", base64_to_bytes(base64), RSA_PARAMS, false, ["encrypt"]);
+}
+
+// the old scheme, plain RSA-OAEP over the whole message, still used by the benchmark page
+async function rsa_encrypt(message, publicKey) {
+    const encrypted = await crypto.subtle.encrypt(RSA_PARAMS, publicKey, new TextEncoder().encode(message));
+    return new Uint8Array(encrypted);
+}
+
+async function rsa_decrypt(ciphertext, privateKey) {
+    const decrypted = await crypto.subtle.decrypt(RSA_PARAMS, privateKey, ciphertext);
+    return new TextDecoder().decode(decrypted);
+}
+
+// a new AES-GCM key for one conversation, wrapped with the recipient's public key
+// the wrapped key goes out with the first message encrypted with it
+async function create_conversation_key(publicKey) {
+    const key = await crypto.subtle.generateKey({ name: "AES-GCM", length: 256 }, true, ["encrypt", "decrypt"]);
+    const raw = await crypto.subtle.exportKey("raw", key);
+    const wrapped = new Uint8Array(await crypto.subtle.encrypt(RSA_PARAMS, publicKey, raw));
+    return {
+        key: key,
+        id: crypto.getRandomValues(new Uint8Array(KEY_ID_LENGTH)),
+        wrapped: wrapped,
+        sent: false,
+    };
+}
+
+// encrypts one message with the conversation key, returns the envelope as a Uint8Array
+async function hybrid_encrypt(message, conversation) {
+    const withKey = !conversation.sent;
+    const header = new Uint8Array(1 + KEY_ID_LENGTH + (withKey ? 2 + conversation.wrapped.length : 0));
+    header[0] = withKey ? ENVELOPE_WITH_KEY : ENVELOPE_MESSAGE;
+    header.set(conversation.id, 1);
+    if (withKey) {
+        new DataView(header.buffer).setUint16(1 + KEY_ID_LENGTH, conversation.wrapped.length);
+        header.set(conversation.wrapped, 3 + KEY_ID_LENGTH);
+    }
+
+    const iv = crypto.getRandomValues(new Uint8Array(IV_LENGTH));
+    const encrypted = await crypto.subtle.encrypt(
+        { name: "AES-GCM", iv: iv, additionalData: header },
+        conversation.key,
+        new TextEncoder().encode(message)
+    );
+    conversation.sent = true;
+
+    const envelope = new Uint8Array(header.length + IV_LENGTH + encrypted.byteLength);
+    envelope.set(header);
+    envelope.set(iv, header.length);
+    envelope.set(new Uint8Array(encrypted), header.length + IV_LENGTH);
+    return envelope;
+}
+
+// decrypts one envelope
+// keys maps a key id (as hex) to a promise of the conversation key, envelopes carrying
+// a wrapped key add it, later ones look it up, so envelopes must be passed in order
+async function hybrid_decrypt(envelope, privateKey, keys) {
+    const bytes = new Uint8Array(envelope);
+    const id = Array.from(bytes.subarray(1, 1 + KEY_ID_LENGTH), b => b.toString(16).padStart(2, "0")).join("");
+    let offset = 1 + KEY_ID_LENGTH;
+
+    if (bytes[0] == ENVELOPE_WITH_KEY) {
+        const length = new DataView(bytes.buffer, bytes.byteOffset).getUint16(offset);
+        const wrapped = bytes.slice(offset + 2, offset + 2 + length);
+        offset += 2 + length;
+        if (!keys.has(id)) {
+            keys.set(id, crypto.subtle.decrypt(RSA_PARAMS, privateKey, wrapped).then(raw =>
+                crypto.subtle.importKey("raw", raw, { name: "AES-GCM" }, false, ["decrypt"])));
+        }
+    }
+    else if (bytes[0] != ENVELOPE_MESSAGE) {
+        throw new Error("Unknown message format");
+    }
+
+    if (!keys.has(id)) {
+        throw new Error("Conversation key not received");
+    }
+    const decrypted = await crypto.subtle.decrypt(
+        { name: "AES-GCM", iv: bytes.slice(offset, offset + IV_LENGTH), additionalData: bytes.slice(0, offset) },
+        await keys.get(id),
+        bytes.slice(offset + IV_LENGTH)
+    );
+    return new TextDecoder().decode(decrypted);
+}
@@ -0,0 +1,139 @@
+/*
+    decrypt_pool.js
+    decrypts incoming messages in Web Workers so bursts and history pages don't block the page
+
+    a batch of envelopes is split between the workers by conversation key id, so each
+    worker sees the envelope carrying a key before the ones that only name it,
+    and the plaintexts come back in the order the envelopes were given
+    without worker support everything is decrypted on the page instead, and so is
+    everything after a worker fails, including the batches it still had
+*/
+
+const KEY_ID_OFFSET = 1;
+
+class DecryptPool {
+    constructor(privateKey, size = Math.min(navigator.hardwareConcurrency || 2, 4)) {
+        this.privateKey = privateKey;
+        this.workers = [];
+        // maps the id of a part sent to a worker to {envelopes, done}
+        this.pending = new Map();
+        this.next_id = 0;
+        // the conversation keys for decrypting on the page when there are no workers
+        this.keys = new Map();
+
+        if (typeof Worker == "undefined") {
+            return;
+        }
+        try {
+            for (let i = 0; i < size; i++) {
+                const worker = new Worker("/static/js/decrypt_worker.js");
+                worker.onmessage = (event) => this.receive(event.data);
+                worker.onerror = (event) => this.fail(event.message);
+                worker.onmessageerror = () => this.fail("could not read a worker's reply");
+                this.workers.push(worker);
+                // throws a DataCloneError where CryptoKeys can't be sent to workers
+                worker.postMessage({ privateKey: privateKey });
+            }
+        }
+        catch (err) {
+            this.fail(err.message);
+        }
+    }
+
+    // stops using the workers and decrypts the parts they still had on the page,
+    // so every batch still resolves
+    // the keys the workers unwrapped are lost, messages under them show as undecryptable
+    fail(reason) {
+        if (this.workers.length == 0) {
+            return;
+        }
+        console.warn("Decrypt worker failed, decrypting on the page instead:", reason);
+        this.workers.forEach(worker => worker.terminate());
+        this.workers = [];
+
+        for (const id of Array.from(this.pending.keys())) {
+            this.fail_part(id);
+        }
+    }
+
+    decrypt_here(envelopes) {
+        return Promise.all(envelopes.map(envelope =>
+            hybrid_decrypt(envelope, this.privateKey, this.keys).catch(() => null)));
+    }
+
+    // which worker handles an envelope, every envelope of one conversation key goes to the same one
+    worker_index(envelope) {
+        const id = new Uint8Array(envelope, KEY_ID_OFFSET, 4);
+        return ((id[0] << 24 | id[1] << 16 | id[2] << 8 | id[3]) >>> 0) % this.workers.length;
+    }
+
+    // resolves with the plaintexts of the envelopes (ArrayBuffers) in the same order,
+    // null for envelopes that couldn't be decrypted
+    decrypt_batch(envelopes) {
+        if (this.workers.length == 0) {
+            return this.decrypt_here(envelopes);
+        }
+
+        // the positions of the envelopes each worker gets
+        const parts = this.workers.map(() => []);
+        envelopes.forEach((envelope, index) => {
+            if (envelope.byteLength > KEY_ID_OFFSET + 4) {
+                parts[this.worker_index(envelope)].push(index);
+            }
+        });
+
+        return new Promise(resolve => {
+            const plaintexts = new Array(envelopes.length).fill(null);
+            let remaining = parts.filter(part => part.length > 0).length;
+            if (remaining == 0) {
+                resolve(plaintexts);
+                return;
+            }
+            parts.forEach((part, worker) => {
+                if (part.length == 0) {
+                    return;
+                }
+                const id = this.next_id++;
+                const part_envelopes = part.map(index => envelopes[index]);
+                this.pending.set(id, {
+                    envelopes: part_envelopes,
+                    done: (results) => {
+                        part.forEach((index, i) => plaintexts[index] = results[i]);
+                        remaining -= 1;
+                        if (remaining == 0) {
+                            resolve(plaintexts);
+                        }
+                    },
+                });
+                // a worker failing part way through this loop moves the parts already sent to the page
+                if (this.workers.length == 0) {
+                    this.fail_part(id);
+                    return;
+                }
+                try {
+                    this.workers[worker].postMessage({ id: id, envelopes: part_envelopes });
+                }
+                catch (err) {
+                    this.fail(err.message);
+                }
+            });
+        });
+    }
+
+    // decrypts one pending part on the page
+    fail_part(id) {
+        const part = this.pending.get(id);
+        this.pending.delete(id);
+        this.decrypt_here(part.envelopes).then(part.done);
+    }
+
+    receive(data) {
+        const part = this.pending.get(data.id);
+        // already decrypted on the page after a worker failed
+        if (part === undefined) {
+            return;
+        }
+        this.pending.delete(data.id);
+        part.done(data.plaintexts);
+    }
+}
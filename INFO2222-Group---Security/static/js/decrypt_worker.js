@@ -0,0 +1,29 @@
+/*
+    decrypt_worker.js
+    decrypts batches of message envelopes off the main thread, see decrypt_pool.js
+
+    messages:
+        {privateKey}            the user's private CryptoKey, sent once when the worker starts
+        {id, envelopes}         a batch, answered with {id, plaintexts} in the same order,
+                                null where an envelope couldn't be decrypted
+*/
+
+importScripts("/static/js/chat_crypto.js");
+
+let privateKey = null;
+// conversation keys unwrapped by this worker, by key id
+// the pool sends every envelope of a conversation key to the same worker
+const keys = new Map();
+
+self.onmessage = async (event) => {
+    if (event.data.privateKey) {
+        privateKey = event.data.privateKey;
+        return;
+    }
+
+    // every envelope is started before any is awaited, so WebCrypto runs them side by side
+    // and a key carried by one envelope is already known to the ones after it
+    const plaintexts = await Promise.all(event.data.envelopes.map(envelope =>
+        hybrid_decrypt(envelope, privateKey, keys).catch(() => null)));
+    self.postMessage({ id: event.data.id, plaintexts: plaintexts });
+};
@@ -0,0 +1,100 @@
+/*
+    key_store.js
+    keeps each user's RSA key pair in IndexedDB, so it is made once per browser instead of on every visit
+
+    the private key is stored as a non-extractable CryptoKey, so page scripts can decrypt
+    with it but can't read it out, and the base64 public key is stored next to it
+    browsers without IndexedDB or workers still work, they just get a new key pair every time
+*/
+
+const KEY_DATABASE = "chat_keys";
+const KEY_STORE = "key_pairs";
+
+function open_key_database() {
+    return new Promise((resolve, reject) => {
+        const request = indexedDB.open(KEY_DATABASE, 1);
+        request.onupgradeneeded = () => request.result.createObjectStore(KEY_STORE);
+        request.onsuccess = () => resolve(request.result);
+        request.onerror = () => reject(request.error);
+    });
+}
+
+// runs one request against the key store and resolves with its result
+async function key_store_request(mode, action) {
+    const database = await open_key_database();
+    try {
+        return await new Promise((resolve, reject) => {
+            const request = action(database.transaction(KEY_STORE, mode).objectStore(KEY_STORE));
+            request.onsuccess = () => resolve(request.result);
+            request.onerror = () => reject(request.error);
+        });
+    }
+    finally {
+        database.close();
+    }
+}
+
+// a fresh key pair from keygen_worker.js, or made right here without worker support
+function generate_key_pair() {
+    if (typeof Worker == "undefined") {
+        return generate_key_pair_inline();
+    }
+    return new Promise((resolve, reject) => {
+        const worker = new Worker("/static/js/keygen_worker.js");
+        worker.onmessage = (event) => {
+            worker.terminate();
+            if (event.data.error) {
+                reject(new Error(event.data.error));
+            }
+            else {
+                resolve(event.data);
+            }
+        };
+        worker.onerror = (event) => {
+            worker.terminate();
+            reject(new Error(event.message));
+        };
+        worker.postMessage(null);
+    });
+}
+
+async function generate_key_pair_inline() {
+    const keyPair = await crypto.subtle.generateKey({
+        name: "RSA-OAEP",
+        modulusLength: 2048,
+        publicExponent: new Uint8Array([1, 0, 1]),
+        hash: { name: "SHA-256" }
+    }, false, ["encrypt", "decrypt"]);
+    const exported = new Uint8Array(await crypto.subtle.exportKey("spki", keyPair.publicKey));
+    return { publicKey: keyPair.publicKey, privateKey: keyPair.privateKey, public_key: btoa(String.fromCharCode(...exported)) };
+}
+
+// the stored key pair of username, generating and storing one the first time
+// resolves with {publicKey, privateKey, public_key}
+async function load_key_pair(username) {
+    try {
+        const stored = await key_store_request("readonly", store => store.get(username));
+        if (stored) {
+            return stored;
+        }
+    }
+    catch (err) {
+        console.warn("Key store unavailable, using a new key pair:", err);
+        return generate_key_pair();
+    }
+
+    const keyPair = await generate_key_pair();
+    try {
+        await key_store_request("readwrite", store => store.put(keyPair, username));
+    }
+    catch (err) {
+        console.warn("Could not store the key pair:", err);
+    }
+    return keyPair;
+}
+
+// the same fingerprint db.key_fingerprint gives, the first 32 hex digits of SHA-256 of the base64 key
+async function key_fingerprint(public_key) {
+    const digest = new Uint8Array(await crypto.subtle.digest("SHA-256", new TextEncoder().encode(public_key)));
+    return Array.from(digest, b => b.toString(16).padStart(2, "0")).join("").slice(0, 32);
+}
@@ -0,0 +1,28 @@
+/*
+    keygen_worker.js
+    generates the user's RSA-OAEP key pair off the main thread, see key_store.js
+
+    the private key is not extractable, the public key comes back as base64 spki
+    ready to be uploaded, CryptoKeys survive postMessage so nothing is exported
+*/
+
+self.onmessage = async () => {
+    try {
+        const keyPair = await crypto.subtle.generateKey({
+            name: "RSA-OAEP",
+            modulusLength: 2048,
+            publicExponent: new Uint8Array([1, 0, 1]),
+            hash: { name: "SHA-256" }
+        }, false, ["encrypt", "decrypt"]);
+
+        const exported = new Uint8Array(await crypto.subtle.exportKey("spki", keyPair.publicKey));
+        self.postMessage({
+            publicKey: keyPair.publicKey,
+            privateKey: keyPair.privateKey,
+            public_key: btoa(String.fromCharCode(...exported)),
+        });
+    }
+    catch (err) {
+        self.postMessage({ error: err.message });
+    }
+};
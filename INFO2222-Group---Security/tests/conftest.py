@@ -0,0 +1,21 @@
+'''
+conftest
+shared setup for the tests, run them from the project folder:
+    python -m pytest tests
+
+the app is pointed at a scratch database before anything imports db.py
+'''
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+PROJECT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(PROJECT))
+
+SCRATCH = tempfile.mkdtemp()
+os.environ["DB_URL"] = f"sqlite:///{os.path.join(SCRATCH, 'test.db')}"
+# cheap hashes, the tests don't care how strong they are
+os.environ.setdefault("PASSWORD_HASH_COST", "1000")
+os.environ.setdefault("PASSWORD_HASH_WORKERS", "1")
@@ -0,0 +1,70 @@
+'''
+test_auth
+login tokens have to be turned down when they are forged, expired or revoked
+'''
+
+import time
+
+import auth
+from app import app
+
+
+def test_token_names_its_user():
+    assert auth.verify_token(auth.issue_token("auth_alice")) == "auth_alice"
+
+
+def test_forged_tokens_are_rejected():
+    token = auth.issue_token("auth_alice")
+    payload, signature = token.rsplit(".", 1)
+    name, expiry, nonce = payload.split(".")
+
+    # someone else's name under alice's signature
+    assert auth.verify_token(f"{auth.b64encode(b'auth_mallory')}.{expiry}.{nonce}.{signature}") is None
+    # a later expiry under the same signature
+    assert auth.verify_token(f"{name}.{int(expiry) + 3600}.{nonce}.{signature}") is None
+    assert auth.verify_token(f"{payload}.") is None
+    assert auth.verify_token(f"{payload}.{signature}.extra") is None
+    assert auth.verify_token(None) is None
+    # non-ASCII signatures are just wrong, not a crash
+    assert auth.verify_token(f"{payload}.é") is None
+    assert auth.verify_token("YQ.1792394260.abc.é") is None
+
+
+def test_expired_token_is_rejected(monkeypatch):
+    monkeypatch.setattr(auth, "token_ttl", -1)
+    assert auth.verify_token(auth.issue_token("auth_alice")) is None
+
+
+def test_revoked_token_is_rejected_and_others_are_not():
+    token = auth.issue_token("auth_alice")
+    other = auth.issue_token("auth_alice")
+    auth.revoke_token(token)
+    assert auth.verify_token(token) is None
+    assert auth.verify_token(other) == "auth_alice"
+
+
+def test_deny_list_drops_expired_tokens(monkeypatch):
+    monkeypatch.setattr(auth, "deny_list", {})
+    monkeypatch.setattr(auth, "token_ttl", 60)
+    short = auth.issue_token("auth_alice")
+    monkeypatch.setattr(auth, "token_ttl", 3600)
+    long = auth.issue_token("auth_alice")
+    auth.revoke_token(short)
+    auth.revoke_token(long)
+    assert len(auth.deny_list) == 2
+
+    # once the short token has expired, the next revocation prunes it
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 120)
+    auth.revoke_token(auth.issue_token("auth_alice"))
+    assert short.rsplit(".", 1)[1] not in auth.deny_list
+    assert long.rsplit(".", 1)[1] in auth.deny_list
+    assert len(auth.deny_list) == 2
+
+
+def test_non_ascii_cookie_is_forbidden_not_an_error(monkeypatch):
+    monkeypatch.setattr(auth, "enabled", True)
+    client = app.test_client()
+    client.set_cookie("localhost", auth.COOKIE_NAME, "YQ.1792394260.abc.é")
+    response = client.get("/friends_list?username=a")
+    assert response.status_code == 403
@@ -0,0 +1,47 @@
+'''
+test_friends_list
+the friends list page must load everything it shows with one query,
+however many friends and requests the user has
+'''
+
+from sqlalchemy import event
+
+import db
+from app import app
+
+
+def count_queries(function):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        function()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", before_cursor_execute)
+    return statements
+
+
+def test_friends_list_is_one_query():
+    db.insert_user("dashboard_owner", "password")
+    for i in range(10):
+        name = f"dashboard_friend{i}"
+        db.insert_user(name, "password")
+        if i < 5:
+            db.add_friend("dashboard_owner", name)
+        elif i < 8:
+            db.send_friend_request(name, "dashboard_owner")
+        else:
+            db.send_friend_request("dashboard_owner", name)
+    db.clear_caches()
+
+    client = app.test_client()
+    responses = []
+    statements = count_queries(lambda: responses.append(client.get("/friends_list?username=dashboard_owner")))
+
+    assert responses[0].status_code == 200
+    for i in range(10):
+        assert f"dashboard_friend{i}".encode() in responses[0].data
+    assert len(statements) == 1, statements
@@ -0,0 +1,44 @@
+'''
+test_hashing
+the hashing pool's counters have to tell completed work from failed work
+'''
+
+import time
+
+import pytest
+
+import hashing
+
+
+def test_failed_hash_is_not_counted_as_completed():
+    before = hashing.stats()
+    with pytest.raises(AttributeError):
+        hashing.run(hashing.hasher.hash, None)
+    assert hashing.run(hashing.hasher.hash, "password").startswith(hashing.hasher.prefix())
+
+    after = hashing.stats()
+    assert after["failed"] == before["failed"] + 1
+    assert after["completed"] == before["completed"] + 1
+    assert after["in_flight"] == 0
+
+
+def test_failed_submit_is_not_counted_as_completed():
+    before = hashing.stats()
+    future = hashing.submit(hashing.hasher.hash, None)
+    with pytest.raises(AttributeError):
+        future.result()
+    # the done callback may run just after result returns
+    deadline = time.monotonic() + 5
+    while hashing.stats()["in_flight"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    after = hashing.stats()
+    assert after["failed"] == before["failed"] + 1
+    assert after["completed"] == before["completed"]
+
+
+def test_scrypt_calibration_times_the_smallest_cost(monkeypatch):
+    monkeypatch.setattr(hashing, "time_hash", lambda hasher: hasher.cost / 2 ** 12 * 0.1)
+    assert hashing.ScryptHasher.calibrate(0.25) == 2 ** 13
+    with pytest.raises(ValueError):
+        hashing.ScryptHasher.calibrate(0.05)
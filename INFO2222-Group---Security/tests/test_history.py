@@ -0,0 +1,41 @@
+'''
+test_history
+a page of history has to come with the key carrying messages its messages need,
+only the first message under a conversation key carries it
+'''
+
+import db
+
+
+def envelope(kind: int, key_id: bytes, body: bytes) -> bytes:
+    return bytes([kind]) + key_id + body
+
+
+def test_page_gets_the_key_from_an_older_page():
+    conversation = db.Message.conversation("history_a", "history_b")
+    carrier = envelope(db.ENVELOPE_WITH_KEY, b"key1", b"wrapped key and first message")
+    writer = db.MessageWriter(flush_interval=60, batch_size=256)
+    writer.append(conversation, "history_a", carrier)
+    for i in range(5):
+        writer.append(conversation, "history_a", envelope(2, b"key1", bytes([i])))
+    writer.flush()
+
+    page = db.get_messages("history_b", "history_a", limit=3)
+    assert carrier not in [row[2] for row in page.messages]
+    assert page.keys == [("history_a", carrier)]
+
+    # the oldest page has the carrier itself, nothing extra is sent
+    older = db.get_messages("history_b", "history_a", before=page.next_before, limit=3)
+    assert carrier in [row[2] for row in older.messages]
+    assert older.keys == []
+
+
+def test_keys_of_other_conversations_are_not_sent():
+    writer = db.MessageWriter(flush_interval=60, batch_size=256)
+    writer.append(db.Message.conversation("history_c", "history_d"), "history_c",
+                  envelope(db.ENVELOPE_WITH_KEY, b"key2", b"carrier"))
+    writer.append(db.Message.conversation("history_e", "history_f"), "history_e",
+                  envelope(2, b"key2", b"message"))
+    writer.flush()
+
+    assert db.get_messages("history_f", "history_e").keys == []
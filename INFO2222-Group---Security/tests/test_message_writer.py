@@ -0,0 +1,43 @@
+'''
+test_message_writer
+the background message writer has to survive a failed write
+'''
+
+import db
+
+
+def test_failed_write_is_retried(monkeypatch):
+    begin = db.engine.begin
+    calls = []
+
+    def fail_once():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError("database is locked")
+        return begin()
+
+    monkeypatch.setattr(db.engine, "begin", fail_once)
+    writer = db.MessageWriter(flush_interval=60, batch_size=256)
+    writer.append(db.Message.conversation("writer_a", "writer_b"), "writer_a", b"first")
+    writer.flush()
+    assert writer.pending and writer.thread.is_alive()
+
+    writer.append(db.Message.conversation("writer_a", "writer_b"), "writer_a", b"second")
+    writer.flush()
+    assert not writer.pending
+
+    page = db.get_messages("writer_a", "writer_b")
+    assert [row[2] for row in page.messages] == [b"first", b"second"]
+
+
+def test_batch_is_dropped_after_repeated_failures(monkeypatch):
+    def always_fail():
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(db.engine, "begin", always_fail)
+    writer = db.MessageWriter(flush_interval=60, batch_size=256)
+    writer.append(db.Message.conversation("writer_c", "writer_d"), "writer_c", b"lost")
+    for _ in range(db.MESSAGE_WRITE_ATTEMPTS):
+        writer.flush()
+    assert not writer.pending
+    assert writer.thread.is_alive()
@@ -0,0 +1,58 @@
+'''
+test_outbox
+a batch that can't be sent has to be retried, and the outbox has to keep running
+'''
+
+from outbox import Outbox
+
+
+class FlakySocketIO():
+    def __init__(self, failures: int):
+        self.failures = failures
+        self.sent = []
+
+    def start_background_task(self, target):
+        pass
+
+    def emit(self, event, messages, to):
+        if self.failures > 0:
+            self.failures -= 1
+            raise OSError("broker is down")
+        self.sent.append((to, list(messages)))
+
+
+def test_failed_batch_is_sent_on_the_next_flush():
+    socketio = FlakySocketIO(failures=1)
+    outbox = Outbox(socketio)
+    outbox.post("room", 1)
+    outbox.flush()
+    assert socketio.sent == []
+
+    outbox.post("room", 2)
+    outbox.flush()
+    assert socketio.sent == [("room", [1, 2])]
+    assert outbox.rooms == {} and outbox.failures == {}
+
+
+def test_full_batch_that_fails_is_kept():
+    socketio = FlakySocketIO(failures=1)
+    outbox = Outbox(socketio, batch_size=2)
+    outbox.post("room", 1)
+    outbox.post("room", 2)
+    assert socketio.sent == []
+    outbox.flush()
+    assert socketio.sent == [("room", [1, 2])]
+
+
+def test_batch_is_dropped_after_repeated_failures():
+    socketio = FlakySocketIO(failures=3)
+    outbox = Outbox(socketio, send_attempts=3)
+    outbox.post("room", 1)
+    for _ in range(3):
+        outbox.flush()
+    assert outbox.rooms == {}
+
+    # later messages still go out
+    outbox.post("room", 2)
+    outbox.flush()
+    assert socketio.sent == [("room", [2])]
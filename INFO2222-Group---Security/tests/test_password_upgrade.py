@@ -0,0 +1,38 @@
+'''
+test_password_upgrade
+hashes made with older settings are replaced in the background after a login
+'''
+
+import time
+
+from sqlalchemy.orm import Session
+
+import db
+import hashing
+from models import User
+
+
+def test_old_hash_is_upgraded():
+    old_hash = hashing.make_hasher("pbkdf2", 2000).hash("password")
+    with Session(db.engine) as session:
+        session.add(User(username="upgrade_user", password=old_hash))
+        session.commit()
+    assert hashing.needs_rehash(old_hash)
+
+    db.upgrade_password_hash("upgrade_user", "password", old_hash)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        db.clear_caches()
+        user = db.get_user("upgrade_user")
+        if not user.needs_rehash():
+            break
+        time.sleep(0.05)
+    assert not user.needs_rehash()
+    assert user.check_password("password")
+
+
+def test_changed_hash_is_left_alone():
+    db.insert_user("upgrade_changed", "new password")
+    db.replace_password_hash("upgrade_changed", "not the current hash", "replacement")
+    db.clear_caches()
+    assert db.get_user("upgrade_changed").check_password("new password")
@@ -0,0 +1,56 @@
+'''
+test_rooms
+the in-memory and sqlite room registries behave the same
+'''
+
+import os
+import threading
+
+import pytest
+
+from models import Room, SqliteRoom
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def registry(request, tmp_path):
+    if request.param == "memory":
+        return Room()
+    return SqliteRoom(os.path.join(tmp_path, "rooms.db"))
+
+
+def test_second_create_joins_the_existing_room(registry):
+    first = registry.create_room("alice", "bob")
+    second = registry.create_room("bob", "alice")
+    assert first == second
+    assert registry.get_room_users(first) == {"alice", "bob"}
+    assert registry.can_chat(first)
+    assert first in registry.get_user_rooms("alice")
+
+
+def test_concurrent_creates_keep_both_users():
+    registry = Room()
+    for i in range(200):
+        sender, receiver = f"user{i}", f"friend{i}"
+        barrier = threading.Barrier(2)
+
+        def create(a, b):
+            barrier.wait()
+            registry.create_room(a, b)
+
+        threads = [threading.Thread(target=create, args=pair) for pair in ((sender, receiver), (receiver, sender))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        room_id = registry.get_room_id(sender, receiver)
+        assert registry.get_room_users(room_id) == {sender, receiver}
+
+
+def test_last_leave_removes_the_room(registry):
+    room_id = registry.create_room("carol", "dave")
+    registry.join_room("dave", room_id)
+    registry.leave_room("carol", room_id)
+    assert registry.get_room_users(room_id) == {"dave"}
+    registry.leave_room("dave")
+    assert registry.get_room_id("carol", "dave") is None
+    assert registry.get_user_rooms("dave") == set()
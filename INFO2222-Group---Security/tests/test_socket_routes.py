@@ -0,0 +1,105 @@
+'''
+test_socket_routes
+checks on who may do what over the chat socket
+'''
+
+import db
+import socket_routes
+from app import app, socketio
+from models import pair_room_id
+
+
+def connect(username, room_id=None):
+    http = app.test_client()
+    http.set_cookie("localhost", "username", username)
+    if room_id is not None:
+        http.set_cookie("localhost", "room_id", str(room_id))
+    return socketio.test_client(app, flask_test_client=http)
+
+
+def make_users(*usernames):
+    for username in usernames:
+        if db.get_user(username) is None:
+            db.insert_user(username, "password")
+
+
+def test_room_cookie_of_someone_elses_room_is_ignored():
+    make_users("cookie_alice", "cookie_bob", "cookie_mallory")
+    alice = connect("cookie_alice")
+    room_id = alice.emit("join", "cookie_alice", "cookie_bob", callback=True)
+    assert room_id == pair_room_id("cookie_alice", "cookie_bob")
+
+    mallory = connect("cookie_mallory", room_id)
+    assert mallory.is_connected()
+    assert mallory.emit("send", "cookie_mallory", b"ciphertext", room_id, callback=True) == "Not in this room!"
+
+    # a participant's cookie still rejoins the room
+    alice_again = connect("cookie_alice", room_id)
+    assert alice_again.emit("send", "cookie_alice", b"ciphertext", room_id, callback=True) != "Not in this room!"
+
+    for client in (alice, mallory, alice_again):
+        client.disconnect()
+
+
+def test_send_rejects_anything_but_ciphertext():
+    make_users("payload_alice", "payload_bob")
+    alice = connect("payload_alice")
+    room_id = alice.emit("join", "payload_alice", "payload_bob", callback=True)
+
+    limit = app.config["MAX_CIPHERTEXT_BYTES"]
+    for message in (1000, 10 ** 10, {"a": 1}, "text", [], [256], [1.5], [0] * (limit + 1), b"", b"x" * (limit + 1)):
+        assert alice.emit("send", "payload_alice", message, room_id, callback=True) == "Invalid message!"
+    for message in (b"\x00\x01", [0, 1, 255]):
+        assert alice.emit("send", "payload_alice", message, room_id, callback=True) != "Invalid message!"
+    alice.disconnect()
+
+
+def test_malformed_room_cookie_still_connects():
+    make_users("cookie_carol")
+    client = connect("cookie_carol", "not a number")
+    assert client.is_connected()
+    client.disconnect()
+
+
+def test_join_remakes_a_room_emptied_after_the_lookup(monkeypatch):
+    make_users("race_alice", "race_bob")
+    alice = connect("race_alice")
+    room_id = alice.emit("join", "race_alice", "race_bob", callback=True)
+    # alice leaves just after bob's join has looked the room up
+    looked_up = socket_routes.room.get_room_id("race_bob", "race_alice")
+    socket_routes.room.leave_room("race_alice", room_id)
+    monkeypatch.setattr(socket_routes.room, "get_room_id", lambda user, other: looked_up)
+
+    bob = connect("race_bob")
+    assert bob.emit("join", "race_bob", "race_alice", callback=True) == room_id
+    assert socket_routes.room.get_participants(room_id) is not None
+    assert "race_bob" in socket_routes.room.get_room_users(room_id)
+    for client in (alice, bob):
+        client.disconnect()
+
+
+def test_disconnect_leaves_the_room_once_every_socket_is_gone():
+    make_users("presence_alice", "presence_bob")
+    alice = connect("presence_alice")
+    alice_tab = connect("presence_alice")
+    bob = connect("presence_bob")
+    room_id = alice.emit("join", "presence_alice", "presence_bob", callback=True)
+    alice_tab.emit("join", "presence_alice", "presence_bob", callback=True)
+    bob.emit("join", "presence_bob", "presence_alice", callback=True)
+    assert socket_routes.room.can_chat(room_id)
+
+    # alice's other tab is still in the room
+    alice.disconnect()
+    assert socket_routes.room.get_room_users(room_id) == {"presence_alice", "presence_bob"}
+
+    alice_tab.disconnect()
+    assert socket_routes.room.get_room_users(room_id) == {"presence_bob"}
+    assert not socket_routes.room.can_chat(room_id)
+
+    # a reconnect with the room cookie puts alice back
+    alice_again = connect("presence_alice", room_id)
+    assert socket_routes.room.can_chat(room_id)
+
+    for client in (alice_again, bob):
+        client.disconnect()
+    assert socket_routes.room.get_room_id("presence_alice", "presence_bob") is None
@@ -0,0 +1,199 @@
+'''
+test_workers
+two app processes sharing one broker and one sqlite room registry,
+users connected to different workers have to be able to chat with each other
+
+each worker is a real app.py process, the test talks Socket.IO to them over websockets
+'''
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+import pytest
+import simple_websocket
+
+import db
+from broker import BrokerServer
+from conftest import PROJECT
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def wait_for_port(port: int, process, timeout: float = 20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"worker on port {port} exited with {process.returncode}")
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"worker on port {port} didn't start")
+
+
+# puts the bytes of a binary event back where Socket.IO left placeholders
+def fill_placeholders(data, attachments):
+    if isinstance(data, dict):
+        if data.get("_placeholder"):
+            return attachments[data["num"]]
+        return {key: fill_placeholders(value, attachments) for key, value in data.items()}
+    if isinstance(data, list):
+        return [fill_placeholders(value, attachments) for value in data]
+    return data
+
+
+# just enough of a Socket.IO client, events are sent as JSON and received events are recorded
+class SocketClient():
+    def __init__(self, port: int, username: str):
+        self.ws = simple_websocket.Client(f"ws://127.0.0.1:{port}/socket.io/?EIO=4&transport=websocket",
+                                          headers={"Cookie": f"username={username}"})
+        self.events = []
+        self.acks = {}
+        self.next_id = 0
+        self.receive()
+        self.ws.send("40")
+        self.connected = None
+        while self.connected is None:
+            packet = self.receive()
+            if packet.startswith("40"):
+                self.connected = True
+            elif packet.startswith("44"):
+                self.connected = False
+            else:
+                self.handle(packet)
+
+    def receive(self, timeout: float = 5):
+        while True:
+            packet = self.ws.receive(timeout=timeout)
+            if packet is None:
+                raise TimeoutError("nothing received")
+            # engine.io ping
+            if packet == "2":
+                self.ws.send("3")
+                continue
+            return packet
+
+    def handle(self, packet: str):
+        if packet.startswith("42"):
+            name, *args = json.loads(packet[2:])
+            self.events.append((name, args))
+        elif packet.startswith("43"):
+            start = packet.index("[")
+            self.acks[int(packet[2:start])] = json.loads(packet[start:])
+        elif packet.startswith("45"):
+            count, payload = packet[2:].split("-", 1)
+            attachments = [self.receive() for _ in range(int(count))]
+            name, *args = fill_placeholders(json.loads(payload), attachments)
+            self.events.append((name, args))
+
+    def emit(self, event: str, *args):
+        ack_id = self.next_id
+        self.next_id += 1
+        self.ws.send(f"42{ack_id}" + json.dumps([event, *args]))
+        while ack_id not in self.acks:
+            self.handle(self.receive())
+        return self.acks.pop(ack_id)
+
+    def wait_for(self, event: str, timeout: float = 5):
+        deadline = time.monotonic() + timeout
+        while True:
+            for name, args in self.events:
+                if name == event:
+                    self.events.remove((name, args))
+                    return args
+            self.handle(self.receive(max(0.01, deadline - time.monotonic())))
+
+    def close(self):
+        self.ws.close()
+
+
+@pytest.fixture(scope="module")
+def workers(tmp_path_factory):
+    broker_server = BrokerServer(("127.0.0.1", 0))
+    threading.Thread(target=broker_server.serve_forever, daemon=True).start()
+
+    folder = tmp_path_factory.mktemp("workers")
+    env = dict(os.environ,
+               PYTHONPATH=str(PROJECT),
+               SOCKETIO_MESSAGE_QUEUE=f"tcp://127.0.0.1:{broker_server.server_address[1]}",
+               ROOM_REGISTRY="sqlite")
+    ports = [free_port(), free_port()]
+    processes = []
+    for port in ports:
+        log = open(folder / f"worker{port}.log", "w")
+        processes.append(subprocess.Popen(
+            [sys.executable, "-c",
+             f"from app import app, socketio; socketio.run(app, port={port}, allow_unsafe_werkzeug=True)"],
+            cwd=folder, env=env, stdout=log, stderr=subprocess.STDOUT))
+    try:
+        for port, process in zip(ports, processes):
+            wait_for_port(port, process)
+        yield ports
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+        broker_server.shutdown()
+        broker_server.server_close()
+
+
+def test_users_on_different_workers_can_chat(workers):
+    for username in ("worker_alice", "worker_bob"):
+        if db.get_user(username) is None:
+            db.insert_user(username, "password")
+
+    alice = SocketClient(workers[0], "worker_alice")
+    bob = SocketClient(workers[1], "worker_bob")
+    assert alice.connected and bob.connected
+
+    [room_id] = alice.emit("join", "worker_alice", "worker_bob")
+    # bob's worker finds the room alice's worker created
+    assert bob.emit("join", "worker_bob", "worker_alice") == [room_id]
+
+    alice.emit("send", "worker_alice", [1, 2, 3], room_id)
+    [message] = bob.wait_for("incoming_ciphertext")
+    assert message == {"sender": "worker_alice", "ciphertext": b"\x01\x02\x03"}
+
+    bob.emit("send", "worker_bob", [4, 5], room_id)
+    while True:
+        [message] = alice.wait_for("incoming_ciphertext")
+        if message["sender"] == "worker_bob":
+            break
+    assert message["ciphertext"] == b"\x04\x05"
+
+    alice.close()
+    bob.close()
+
+
+def test_signup_on_one_worker_is_seen_by_the_other(workers):
+    # the second worker caches the unknown user before it signs up
+    early = SocketClient(workers[1], "worker_late")
+    assert not early.connected
+    early.close()
+
+    request = urllib.request.Request(f"http://127.0.0.1:{workers[0]}/signup/user",
+                                     data=json.dumps({"username": "worker_late", "password": "password"}).encode(),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request) as response:
+        assert not response.read().startswith(b"Error")
+
+    deadline = time.monotonic() + 2
+    while True:
+        late = SocketClient(workers[1], "worker_late")
+        if late.connected or time.monotonic() > deadline:
+            break
+        late.close()
+        time.sleep(0.05)
+    assert late.connected
+    late.close()